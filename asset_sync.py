@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+
+import fs.copy
+import fs.path
+from fs.errors import NoSysPath
+
+from netlify import file_sha1
+
+def _syspath(a_fs, path):
+    try:
+        return a_fs.getsyspath(path)
+    except NoSysPath:
+        return None
+
+def _same_content(src_fs, dst_fs, path):
+    return file_sha1(src_fs, path) == file_sha1(dst_fs, path)
+
+def _sync_os_file(src_fs, dst_fs, path, src, dst, link):
+    src_stat = os.stat(src)
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+    else:
+        if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+            return False
+        if src_stat.st_size == dst_stat.st_size:
+            if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+                return False
+            if _same_content(src_fs, dst_fs, path):
+                os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+                return False
+        # never write through the old file, it may be a hardlink to a source
+        os.remove(dst)
+    
+    if link:
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            pass
+    # copy2 keeps the mtime for the next comparison and uses sendfile where available
+    shutil.copy2(src, dst)
+    return True
+
+def _sync_file(src_fs, dst_fs, path, link):
+    src = _syspath(src_fs, path)
+    dst = _syspath(dst_fs, path)
+    if src and dst:
+        return _sync_os_file(src_fs, dst_fs, path, src, dst, link)
+    
+    if dst_fs.exists(path):
+        if src_fs.getsize(path) == dst_fs.getsize(path) and _same_content(src_fs, dst_fs, path):
+            return False
+    else:
+        dst_fs.makedirs(fs.path.dirname(path), recreate=True)
+    fs.copy.copy_file(src_fs, path, dst_fs, path)
+    return True
+
+def sync_files(src_fs, dst_fs, paths=None, *, prune=False, keep_dirs=(), workers=8, link=False):
+    """Copies files from src_fs to dst_fs, skipping ones that are already up to date
+        
+        paths - files to sync, every file in src_fs if None
+        prune - remove files in dst_fs that aren't in paths
+        keep_dirs - directories of dst_fs that prune leaves alone
+        link - hardlink instead of copying when both are on the same disk
+        
+        Files are compared by size and mtime, and by content when only the
+        mtime differs. Returns the lists of copied and removed paths.
+        
+        """
+    if paths is None:
+        paths = list(src_fs.walk.files())
+    else:
+        paths = [fs.path.abspath(path) for path in paths]
+    
+    with ThreadPoolExecutor(workers) as executor:
+        synced = executor.map(lambda path: _sync_file(src_fs, dst_fs, path, link), paths)
+        copied = [path for path, was_copied in zip(paths, synced) if was_copied]
+    
+    removed = []
+    if prune:
+        keep = set(paths)
+        keep_prefixes = tuple(fs.path.abspath(d).rstrip('/') + '/' for d in keep_dirs)
+        removed = [
+            path for path in dst_fs.walk.files()
+            if path not in keep and not path.startswith(keep_prefixes)
+        ]
+        for path in removed:
+            dst_fs.remove(path)
+    
+    return copied, removed
+
+def sync_static(src_fs, dst_fs, *, workers=8, link=False):
+    """Syncs the static folder into the root of dst_fs
+        
+        Directories of the static folder are mirrored exactly, other files
+        in the root of dst_fs (i.e. generated pages) are left alone.
+        
+        """
+    copied, removed = sync_files(src_fs, dst_fs, [p for p in src_fs.listdir('/') if src_fs.isfile(p)], workers=workers, link=link)
+    for name in src_fs.listdir('/'):
+        if src_fs.isdir(name):
+            dir_copied, dir_removed = sync_files(
+                src_fs.opendir(name), dst_fs.makedir(name, recreate=True),
+                prune=True, workers=workers, link=link,
+            )
+            copied.extend(fs.path.join('/', name, fs.path.relpath(p)) for p in dir_copied)
+            removed.extend(fs.path.join('/', name, fs.path.relpath(p)) for p in dir_removed)
+    return copied, removed
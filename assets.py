@@ -1,39 +1,184 @@
+import json
 import os
+import threading
 
 import requests
-import fs
 from fs import open_fs
+from redis.exceptions import RedisError
+
+from asset_sync import sync_files
+from image_variants import ImageVariants
+
+class RemoteImageIndex:
+    """List of images on the image server, fetched in a background thread
+        
+        The last fetched list is kept in redis if available, otherwise in
+        a file, together with its ETag/Last-Modified so later fetches are
+        conditional requests the server can answer with 304 Not Modified.
+        Until a fetch finishes the cached list is used.
+        
+        """
+    redis_key = 'image_index'
+    
+    def __init__(self, host, auth, *, redis=None, cache_path=None, timeout=10):
+        self.host = host
+        self.auth = auth
+        self.redis = redis
+        self.cache_path = cache_path
+        self.timeout = timeout
+        
+        self.etag = None
+        self.last_modified = None
+        self.images = {}
+        # True once images holds a list, cached or fetched
+        self.loaded = False
+        self._thread = None
+        
+        self._load_cached()
+    
+    def _load_cached(self):
+        try:
+            if self.redis is not None:
+                data = self.redis.get(self.redis_key)
+            elif self.cache_path:
+                with open(self.cache_path, encoding='utf8') as f:
+                    data = f.read()
+            else:
+                data = None
+            if data is None:
+                return
+            cached = json.loads(data)
+        except (OSError, ValueError, RedisError):
+            return
+        if cached.get('host') != self.host:
+            return
+        self.etag = cached.get('etag')
+        self.last_modified = cached.get('last_modified')
+        self.images = cached.get('images', {})
+        self.loaded = True
+    
+    def _save_cached(self):
+        data = json.dumps({
+            'host': self.host,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'images': self.images,
+        })
+        if self.redis is not None:
+            self.redis.set(self.redis_key, data)
+        elif self.cache_path:
+            tmp_path = "{}.tmp".format(self.cache_path)
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.cache_path)
+    
+    def fetch(self):
+        """Revalidates the list with the image server, keeping the cached list on errors"""
+        headers = {
+            'Cookie': 'token={}'.format(self.auth),
+        }
+        if self.images:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        
+        try:
+            res = requests.get('{}/list'.format(self.host), headers=headers, timeout=self.timeout)
+            if res.status_code == 304:
+                self.loaded = True
+                return
+            res.raise_for_status()
+            img_list = res.json()
+        except (requests.RequestException, ValueError) as e:
+            print("image server list failed, using {} cached images: {}".format(len(self.images), e))
+            return
+        
+        images = {img['file_name']: img['url'] for img in img_list.values()}
+        self.etag = res.headers.get('ETag')
+        self.last_modified = res.headers.get('Last-Modified')
+        # swapped in whole, lookups see either the old or the new list
+        self.images = images
+        self.loaded = True
+        try:
+            self._save_cached()
+        except (OSError, RedisError) as e:
+            print("couldn't cache image list:", e)
+    
+    def start(self):
+        """Starts revalidating in the background unless that's already happening"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self.fetch, daemon=True)
+        self._thread.start()
+    
+    def wait(self):
+        """Waits for a running fetch, at most about the request timeout"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(self.timeout * 2)
+            if thread.is_alive():
+                # keep it so start doesn't run a second fetch alongside it
+                print("image server list still loading, using {} cached images".format(len(self.images)))
+            else:
+                self._thread = None
 
 class ImageSrc:
-    def __init__(self, config):
+    def __init__(self, config, *, redis=None):
         self._config = config
+        self._redis = redis
         self.image_folder = config['image-folder']
         self.image_server = config.image_server
         
         self.used_images = set()
+        # images used with image-srcset, which need their variants generated
+        self.used_variants = set()
         
         self.images = {}
-        self.remote_images = {}
+        self._load_image_folder()
+        self.variants = ImageVariants.from_config(config)
         
+        self._remote = None
+        self._remote_ready = True
+        if self.image_server:
+            self._remote = RemoteImageIndex(
+                self.image_server, config.image_server_auth,
+                redis=redis,
+                cache_path=config.get('image-index-cache'),
+                timeout=config.get('image-server-timeout') or 10,
+            )
+            self._remote_ready = False
+            self._remote.start()
+    
+    def _load_image_folder(self):
+        images = {}
         if self.image_folder:
-            for file_name in os.listdir(config['image-folder']):
+            for file_name in os.listdir(self.image_folder):
                 key = file_name.rsplit('.')[0]
                 path = file_name
-                self.images[key] = path
-        
-        if self.image_server:
-            headers = {
-                'Cookie': 'token={}'.format(config.image_server_auth),
-            }
-            res = requests.get('{}/list'.format(self.image_server), headers=headers)
-            
+                images[key] = path
+        self.images = images
+    
+    @property
+    def remote_images(self):
+        if not self._remote_ready:
+            self.wait()
+        return self._remote.images if self._remote is not None else {}
+    
+    def wait(self):
+        """Waits for the image server list if there is no cached copy of it
             
-            img_list = res.json()
+            With a cached list the fetch keeps running in the background and
+            its list replaces the cached one when it's done.
             
-            for img in img_list.values():
-                self.remote_images[img['file_name']] = img['url']
+            """
+        if self._remote is not None and not self._remote.loaded:
+            self._remote.wait()
+        self._remote_ready = True
     
     def __call__(self, command, arg):
+        if command == 'image-srcset':
+            return self.srcset(arg)
         try:
             url = self.remote_images[arg]
             return url
@@ -47,12 +192,80 @@ class ImageSrc:
         except KeyError:
             return ""
     
+    def srcset(self, arg):
+        """<img> (or <picture> with webp) listing the resized variants of an image"""
+        try:
+            return '<img src="{}">'.format(self.remote_images[arg])
+        except KeyError:
+            pass
+        
+        try:
+            path = self.images[arg]
+        except KeyError:
+            return ""
+        self.used_images.add(arg)
+        src = '/assets/{}'.format(path)
+        
+        variants = []
+        if self.variants is not None:
+            try:
+                variants = self.variants.variants(path)
+                width = self.variants.info(path)['width']
+            except OSError as e:
+                print("couldn't read image {}: {}".format(path, e))
+                variants = []
+        if not variants:
+            return '<img src="{}">'.format(src)
+        self.used_variants.add(arg)
+        
+        srcsets = {}
+        for name, variant_width, mime in variants:
+            srcsets.setdefault(mime, []).append("/assets/variants/{} {}w".format(name, variant_width))
+        webp = srcsets.pop('image/webp', None)
+        img_srcset = srcsets.popitem()[1] if srcsets else []
+        img_srcset.append("{} {}w".format(src, width))
+        
+        img = '<img src="{}" srcset="{}" sizes="100vw">'.format(src, ", ".join(img_srcset))
+        if webp is None:
+            return img
+        return '<picture><source type="image/webp" srcset="{}" sizes="100vw">{}</picture>'.format(", ".join(webp), img)
+    
+    def reload_image_folder(self):
+        """Lists image-folder again, keeping the image server's list"""
+        config = self._config
+        self.image_folder = config['image-folder']
+        self.used_images = set()
+        self.used_variants = set()
+        self._load_image_folder()
+        self.variants = ImageVariants.from_config(config)
+    
     def force_reload(self):
-        ImageSrc.__init__(self, self._config)
+        config = self._config
+        if self._remote is None or self._remote.host != config.image_server:
+            ImageSrc.__init__(self, config, redis=self._redis)
+            return
+        
+        # keep the remote list and revalidate it in the background
+        self.reload_image_folder()
+        self._remote.auth = config.image_server_auth
+        self._remote_ready = False
+        self._remote.start()
     
-    def add_assets(self, asset_fs):
-        if self.image_folder:
-            with open_fs("osfs://{}".format(self.image_folder)) as static_fs:
-                for key, path in self.images.items():
-                    if key in self.used_images and not asset_fs.exists(path):
-                        fs.copy.copy_file(static_fs, path, asset_fs, path)
+    def add_assets(self, asset_fs, *, prune=False, workers=8, link=False):
+        """Copies used images and their variants to asset_fs, prune removes every other file"""
+        if not self.image_folder:
+            return
+        with open_fs("osfs://{}".format(self.image_folder)) as static_fs:
+            paths = [path for key, path in self.images.items() if key in self.used_images]
+            # variants are synced (and pruned) separately below
+            keep_dirs = ['variants'] if self.variants is not None else []
+            sync_files(static_fs, asset_fs, paths, prune=prune, keep_dirs=keep_dirs, workers=workers, link=link)
+        
+        if self.variants is not None:
+            images = [path for key, path in self.images.items() if key in self.used_variants]
+            self.variants.generate(images)
+            variant_paths = [name for path in images for name, _, _ in self.variants.variants(path)]
+            variant_paths = [path for path in variant_paths if os.path.exists(os.path.join(self.variants.cache_path, path))]
+            with open_fs("osfs://{}".format(self.variants.cache_path)) as cache_fs:
+                variant_fs = asset_fs.makedir('variants', recreate=True)
+                sync_files(cache_fs, variant_fs, variant_paths, prune=prune, workers=workers, link=link)
@@ -0,0 +1,59 @@
+"""Measures the memory used per Page node of a page tree
+
+python benchmarks/page_memory.py [volumes] [chapters]
+
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from page import Page
+
+class BenchConfig:
+    path_prefix = ''
+    series_prefix = True
+
+class BenchSeries:
+    config = BenchConfig()
+    hier = ['volume', 'chapter']
+    path_part = 'bench'
+
+def build_tree(volumes, chapters):
+    # content is shared between pages so only the tree itself is measured
+    content = 'x' * 1000
+    root = Page(series=BenchSeries())
+    for volume in range(1, volumes + 1):
+        for chapter in range(1, chapters + 1):
+            raw_page = {
+                'content': content,
+                'meta': {
+                    'title': 'Chapter',
+                    'order': chapter,
+                },
+            }
+            root.add_page([volume, chapter], raw_page)
+    return root
+
+def main():
+    volumes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    chapters = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    root = build_tree(volumes, chapters)
+    # sorted child lists and memoized paths are part of a built tree
+    for page in root.recurse():
+        page.get_fs_path()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    page_count = sum(1 for _ in root.recurse())
+    print("pages", page_count)
+    print("bytes total", after - before)
+    print("bytes per page", (after - before) // page_count)
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,11 @@
 from pprint import pprint
 from datetime import datetime
 
-import markdown
-import pystache
-
 from page import Page
 
 class Blog(Page):
+    __slots__ = ('posts',)
+    
     def __init__(self):
         self.posts = []
     
@@ -15,6 +14,8 @@ class Blog(Page):
         self.posts.append(post)
 
 class BlogPost(Page):
+    __slots__ = ('multipost',)
+    
     def __init__(self, *args, **kwargs):
         Page.__init__(self, *args, **kwargs)
         self.multipost = False
@@ -28,8 +29,7 @@ class BlogPost(Page):
 def process_blog_posts(posts, series):
     blog = Blog()
     
-    with open('layouts/blog_post.stache') as f:
-        post_template = f.read()
+    page_renderer = series.config.page_renderer
     
     def get_href(post):
         m_blog = post['meta']['blog']
@@ -57,7 +57,7 @@ def process_blog_posts(posts, series):
             preview_content.append('<a href="{}">Read More...</a>'.format(href))
         preview_content = "\n".join(preview_content)
         
-        preview_content = markdown.markdown(preview_content, extensions=['markdown.extensions.footnotes'])
+        preview_content = page_renderer.markdown.convert('markdown', preview_content)
         
         params = {
             'date': pub_date,
@@ -66,7 +66,7 @@ def process_blog_posts(posts, series):
             'title': post['meta']['title'],
             'url': href,
         }
-        post_html = pystache.render(post_template, params)
+        post_html = page_renderer.render_template('blog_post', params)
         
         ca(post_html)
     
@@ -11,11 +11,20 @@ python build.py --page _
 run single page server in debug mode
 python build.py --page debug
 
+keep running and rebuild whenever pages or series change
+python build.py watch
+
+render pages using 4 worker processes
+python build.py --jobs 4
+
+build and write a timing report of every stage and page to profile.json
+python build.py --profile profile.json
+
 """
 
 from pprint import pprint
+import argparse
 import sys
-from itertools import groupby
 import hashlib
 
 from fs.osfs import OSFS
@@ -28,12 +37,17 @@ import hjson
 from redis import Redis
 from pymongo import MongoClient
 
-from page import Page
+from page import Page, page_files
+from manifest import BuildManifest
+from asset_sync import sync_static
+import instrument
 import blog
 
 from util import try_int
 from render import PageRenderer
 from render.prerender import PreRenderer
+from render.parallel import RenderPool
+from render.cache import open_render_cache
 from assets import ImageSrc
 import build_target.fs_target, build_target.debug_target, build_target.netlify_target
 
@@ -48,6 +62,8 @@ class State:
         self.pages = None
         self.other = {}
         self.partial_build = False
+        self.manifest = BuildManifest()
+        self.jobs = 1
         
         self._mongo_connection: MongoClient = None
         self._redis_connection: Redis = None
@@ -117,6 +133,17 @@ class Config:
     def __getitem__(self, key):
         return self.raw_config[key]
 
+# fields read by Series
+series_fields = ['name', 'uuid', 'config.header-url', 'config.hierarchy', 'config.fixed_nav_entries', 'config.blog_path']
+
+# fields read by Page.set_raw_page, blog.process_blog_posts and page_tree_path,
+# the hierarchy fields of each series are added to these
+page_fields = [
+    'series', 'content',
+    'meta.title', 'meta.renderer_t', 'meta.path', 'meta.nav_title', 'meta.hide_nav', 'meta.order',
+    'meta.deleted', 'meta.blog',
+]
+
 class Series:
     def __init__(self, raw_series, config):
         self.config = config
@@ -150,89 +177,158 @@ def retrieve_series(state):
         series_query['name'] = {'$in': config.get('series')}
     if config['min-status'] is not None:
         series_query['config.status'] = {'$gte': config['min-status']}
-    remote_series = remote.ndtest.series.find(series_query)
+    remote_series = remote.ndtest.series.find(series_query, {f: 1 for f in series_fields})
     remote_series = list(remote_series)
     
     return_series = [Series(raw_series, config) for raw_series in remote_series]
     
     return return_series
 
-def retrieve_pages(state, series_list, present_series={}):
+def page_tree_path(raw_page, series):
+    """Path of a page in its series' tree, based on the series hierarchy"""
+    meta = raw_page.get('meta', {})
+    path = [meta.get(h) for h in series.hier]
+    path = [p for p in path if p not in [None, '', 0]]
+    path = [0 if p == '_0' else p for p in path]
+    path = [try_int(p, p) for p in path]
+    
+    path_postfix = meta.get('path')
+    if path_postfix:
+        path.append(path_postfix)
+    
+    return path
+
+def series_fingerprints(state, series_list, page_query):
+    """Hashes identifying the current version of each series' pages
+        
+        Computed with a single aggregation, grouping pages by series. If
+        fingerprint-field is set (e.g. a last updated timestamp or revision
+        counter on pages) only the page count and the field's maximum are
+        returned for each series, otherwise the page uuids are.
+        
+        """
     config = state.config
     remote = state.get_mongo()
     
-    return_series = series_list
+    series_uuids = {s.id: s.uuid for s in series_list}
+    # template changes need to rebuild every series
+    page_renderer = config.page_renderer
+    template_version = page_renderer.template_version if page_renderer else ''
+    
+    fingerprint_field = config.get('fingerprint-field')
+    if fingerprint_field:
+        group = {
+            '_id': '$series',
+            'count': {'$sum': 1},
+            'latest': {'$max': '${}'.format(fingerprint_field)},
+        }
+    else:
+        group = {
+            '_id': '$series',
+            'uuids': {'$push': {'$ifNull': ['$uuid', '']}},
+        }
+    pipeline = [
+        {'$match': page_query},
+        {'$sort': {'series': 1, '_id': 1}},
+        {'$group': group},
+    ]
     
-    series_ids = [s.id for s in return_series]
+    uuid_hashes = {}
+    for res in remote.ndtest.pages.aggregate(pipeline, allowDiskUse=True):
+        series_id = res['_id']
+        m = hashlib.sha256()
+        m.update(series_uuids.get(series_id, '').encode())
+        m.update(template_version.encode())
+        if fingerprint_field:
+            m.update("{}:{}".format(res['count'], res['latest']).encode())
+        else:
+            for uuid in res['uuids']:
+                if not uuid:
+                    uuid = "8"
+                m.update(str(uuid).encode())
+        uuid_hashes[series_id] = m.hexdigest()
+    
+    return uuid_hashes
+
+def series_page_query(config, series_ids):
+    """Query matching the pages of series_ids that are included in builds"""
     page_query = {
         'series': {'$in': series_ids}, 
     }
     if config['min-status'] is not None:
         page_query['meta.status'] = {'$gte': config['min-status']}
+    return page_query
+
+def retrieve_pages(state, series_list, present_series={}, *, page_index=None):
+    """Builds the page trees of the series in series_list that changed since present_series
+        
+        Returns (trees by series id, series_list, series fingerprints).
+        page_index - optional dict, filled with page id -> (series id, path in the tree)
+            for the pages placed by their meta (i.e. not blog posts)
+        
+        """
+    config = state.config
+    remote = state.get_mongo()
     
-    series_uuids = {s.id: s.uuid for s in series_list}
+    return_series = series_list
     
-    remote_uuids = remote.ndtest.pages.find(page_query, {'series': 1, 'uuid': 1, '_id': 0})
-    remote_uuids = sorted(remote_uuids, key=lambda x: x.get('series') or "")
+    page_query = series_page_query(config, [s.id for s in return_series])
     
-    uuid_hashes = {}
-    for series_id, pages in groupby(remote_uuids, lambda x: x.get('series')):
-        m = hashlib.sha256()
-        m.update(series_uuids.get(series_id, '').encode())
-        for uuid in (p.get('uuid') for p in pages):
-            if not uuid:
-                uuid = "8"
-            m.update(uuid.encode())
-        uuid_hashes[series_id] = m.hexdigest()
+    batch_size = config.get('mongo-batch-size') or 1000
+    
+    uuid_hashes = series_fingerprints(state, series_list, page_query)
     
     needed_series = [s for s in return_series if s.id not in present_series or uuid_hashes[s.id] != present_series[s.id]]
     
     page_query = {
         **page_query, # include meta.status part of the query
         'series': {'$in': [s.id for s in needed_series]},
+        'meta.deleted': {'$ne': True},
     }
+    # blog posts are only needed for series that have a blog
+    no_blog_series = [s.id for s in needed_series if s.blog_path is None]
+    if no_blog_series:
+        page_query['$or'] = [
+            {'series': {'$nin': no_blog_series}},
+            {'meta.blog.published_date': {'$exists': False}},
+        ]
+    
+    projection = {f: 1 for f in page_fields}
+    projection.update({'meta.{}'.format(h): 1 for s in needed_series for h in s.hier})
+    if page_index is None:
+        projection['_id'] = 0
     
     if not needed_series:
         remote_pages = []
     else:
-        remote_pages = remote.ndtest.pages.find(page_query)
-    remote_pages = list(remote_pages)
-
-    blog_pages = [p for p in remote_pages if p['meta'].get('blog')]
-    blog_pages = [p for p in blog_pages if not p['meta'].get('deleted')]
-
-    remote_pages = [p for p in remote_pages if not p['meta'].get('deleted')]
-    remote_pages = [p for p in remote_pages if not p['meta'].get('blog')]
+        remote_pages = remote.ndtest.pages.find(page_query, projection).batch_size(batch_size)
+    
+    # build the trees while the cursor is consumed, in a single pass
+    all_pages = {series.id: Page(series=series) for series in needed_series}
+    blog_pages = {series.id: [] for series in needed_series}
+    
+    for page in remote_pages:
+        meta = page['meta']
+        if meta.get('deleted'):
+            continue
+        series_id = page['series']
+        if meta.get('blog'):
+            blog_pages[series_id].append(page)
+            continue
+        root = all_pages[series_id]
+        path = page_tree_path(page, root.series)
+        root.add_page(path, page)
+        if page_index is not None:
+            page_index[str(page['_id'])] = (series_id, tuple(path))
     
-    all_pages = {}
-
     for series in needed_series:
-        hier = series.hier
-        series_id = series.id
-        pages = [p for p in remote_pages if p['series'] == series_id]
-        series_blog_pages = [p for p in blog_pages if p['series'] == series_id]
-        
-        root = Page(series=series)
-        all_pages[series.id] = root
-        
-        for page in pages:
-            path = [page.get('meta', {}).get(h) for h in hier]
-            path = [p for p in path if p not in [None, '', 0]]
-            path = [0 if p == '_0' else p for p in path]
-            path = [try_int(p, p) for p in path]
-            
-            path_postfix = page['meta'].get('path')
-            if path_postfix:
-                path.append(path_postfix)
-            
-            root.add_page(path, page)
-        
+        root = all_pages[series.id]
         if series.blog_path is not None:
-            for path, page in blog.process_blog_posts(series_blog_pages, series):
+            for path, page in blog.process_blog_posts(blog_pages[series.id], series):
                 if path == []:
                     for child in root:
                         child.change_root(page)
-                    page.children = root.children
+                    page.set_children(root.children)
                     root = page
                     all_pages[series.id] = root
                 else:
@@ -240,28 +336,77 @@ def retrieve_pages(state, series_list, present_series={}):
     
     return all_pages, return_series, uuid_hashes
 
-def gen_fs(test_fs, all_pages, series_list, config, state, include_static=True, noisy=False):
-    if not state.partial_build:
-        test_fs.removetree('/')
+def gen_fs(test_fs, all_pages, series_list, config, state, include_static=True, noisy=False, incremental=False, write_pages=True):
+    """Renders all_pages into test_fs
+        
+        Pages whose hash matches state.manifest are left untouched. Returns the
+        paths of files belonging to pages that no longer exist.
+        
+        incremental - update test_fs in place like a partial build, for
+            regenerating the same series after e.g. a template change
+        write_pages - can be set to False to only write static files and
+            assets, for serving pages that are rendered on request
+        
+        """
+    manifest = state.manifest
+    manifest.commit()
+    removed = []
+    
+    if not (state.partial_build or incremental):
+        manifest.clear()
+        # static files and assets are synced below, only copying changed files
+        with open_fs("osfs://static") as static_fs:
+            keep = set(static_fs.listdir('/'))
+        keep.add('assets')
+        for d in test_fs.listdir('/'):
+            if d in keep:
+                continue
+            if test_fs.isfile(d):
+                test_fs.remove(d)
+            else:
+                test_fs.removetree(d)
     else:
-        series_parts = [root.series.path_part for _, root in all_pages.items()]
+        series_parts = {root.series.path_part: series_id for series_id, root in all_pages.items()}
         for d in test_fs.listdir('/'):
             if d in ['static', 'assets']:
                 continue
             # don't delete files that aren't being rebuilt
             if d not in series_parts:
                 continue
+            # pages are updated in place when there is a manifest for the series
+            if manifest.has_series(series_parts[d]):
+                continue
             if test_fs.isfile(d):
                 test_fs.remove(d)
             else:
                 test_fs.removetree(d)
     
-    for series_id, root in all_pages.items():
-        if config.series_prefix:
-            test_fs.makedir(root.series.path_part)
-            root.build_fs(test_fs.opendir(root.series.path_part))
-        else:
-            root.build_fs(test_fs)
+    page_renderer = config.page_renderer
+    changed = {}
+    with instrument.stage("hash pages"):
+        for series_id, root in (all_pages.items() if write_pages else ()):
+            changed[series_id] = [
+                page for page in root.recurse()
+                if manifest.update(series_id, page.get_out_path(), page_renderer.page_hash(page))
+            ]
+    
+    # one pool of workers renders the changed pages of every series
+    with RenderPool([page for pages in changed.values() for page in pages], state.jobs) as render_pool:
+        for series_id, pages in changed.items():
+            root = all_pages[series_id]
+            if config.series_prefix:
+                series_dir = root.series.path_part
+                test_fs.makedir(series_dir, recreate=True)
+                series_fs = test_fs.opendir(series_dir)
+            else:
+                series_dir = ''
+                series_fs = test_fs
+            
+            with instrument.stage("series {}".format(root.series.name)):
+                root.build_fs(series_fs, render_pool.render(pages))
+            
+            for page_path in manifest.stale_pages(series_id):
+                removed.extend(fs.path.join(series_dir, path) for path in remove_page_files(series_fs, page_path))
     
     #generate an index page of series if multi series site
     if config.series_prefix:
@@ -270,44 +415,97 @@ def gen_fs(test_fs, all_pages, series_list, config, state, include_static=True,
             for series in series_list:
                 f.write('<div><a href="{}">{}</a><br></div>'.format(series.path_part, series.name))
     
+    sync_workers = config.get('asset-sync-workers') or 8
+    link = bool(config.get('asset-hardlinks'))
     if not state.partial_build or include_static:
-        with open_fs("osfs://static") as static_fs:
-            fs.copy.copy_fs(static_fs, test_fs)
+        with instrument.stage("static"), open_fs("osfs://static") as static_fs:
+            sync_static(static_fs, test_fs, workers=sync_workers, link=link)
     try:
         image_ext = config.page_renderer.prerenderer.extensions['image']
     except (AttributeError, KeyError):
         pass
     else:
         test_fs.makedir('assets', recreate=True)
-        image_ext.add_assets(test_fs.opendir('assets'))
-
-def gen_single_page(state, page_id, *, inner_only=False,):
-    single_page = page_id
-    config = state.config
+        # only full builds know every used image
+        with instrument.stage("assets"):
+            image_ext.add_assets(test_fs.opendir('assets'), prune=not state.partial_build, workers=sync_workers, link=link)
     
+    return removed
+
+def remove_page_files(out_fs, page_path):
+    """Removes the files Page.build_fs writes for a page, returns their paths"""
+    paths = [fs.path.join(page_path, p) for p in page_files]
+    for path in paths:
+        if out_fs.isfile(path):
+            out_fs.remove(path)
+    
+    for path in (fs.path.join(page_path, 'raw'), page_path):
+        if path and out_fs.isdir(path) and out_fs.isempty(path):
+            out_fs.removedir(path)
+    
+    return paths
+
+def fetch_single_page(state, page_id):
+    """Reads a page and its series from mongo, None if there's no such page"""
     remote = state.get_mongo()
     from bson.objectid import ObjectId
-    page_id = ObjectId(single_page)
-    remote_pages = remote.ndtest.pages.find({'_id': page_id})
+    from bson.errors import InvalidId
     try:
-        raw_page = next(remote_pages)
-    except StopIteration:
-        print("page not found")
-        return {'data': 'page not found'}
+        page_id = ObjectId(page_id)
+    except InvalidId:
+        return None
+    raw_page = remote.ndtest.pages.find_one({'_id': page_id})
+    if raw_page is None:
+        return None
     
     series_id = ObjectId(raw_page['series'])
-    raw_series = remote.ndtest.series.find({'_id': series_id})
-    raw_series = next(raw_series)
-    series = Series(raw_series, config)
-    
+    raw_series = remote.ndtest.series.find_one({'_id': series_id})
+    if raw_series is None:
+        return None
+    return raw_page, raw_series
+
+def single_page_tree(state, raw_page, raw_series):
+    """A series tree containing only raw_page, at its root"""
+    series = Series(raw_series, state.config)
     root = Page(series=series)
     path = []
     root.add_page(path, raw_page)
+    return root
+
+def single_page_etag(state, page, *, inner_only=False):
+    """ETag of a single page preview, changes whenever the rendered page would"""
+    page_hash = state.config.page_renderer.page_hash(page)
+    return '"{}{}"'.format(page_hash[:32], '-inner' if inner_only else '')
+
+def gen_single_page(state, page_id, *, inner_only=False,):
+    fetched = fetch_single_page(state, page_id)
+    if fetched is None:
+        print("page not found")
+        return {'data': 'page not found'}
     
+    root = single_page_tree(state, *fetched)
     return {
         'data': root.render(inner_only=inner_only)
     }
 
+def run_build(state, deploy_target, present_series, noisy=True):
+    """Builds the series that changed since present_series, returns the new series hashes"""
+    with instrument.stage("retrieve_series"):
+        series_list = retrieve_series(state)
+    with instrument.stage("retrieve_pages"):
+        all_pages, series_list, uuid_hashes = retrieve_pages(state, series_list, present_series)
+    
+    if uuid_hashes == present_series:
+        if noisy:
+            print("NOTHING TO DO")
+        return uuid_hashes
+    
+    with instrument.stage("gen_fs"):
+        deploy_target.gen_fs(all_pages, series_list)
+    with instrument.stage("post_gen"):
+        deploy_target.post_gen(uuid_hashes)
+    return uuid_hashes
+
 def main():
     try:
         config_fn_i = sys.argv.index('--config')
@@ -326,17 +524,28 @@ def main():
         single_page_out = sys.argv[config_page_out_i + 1]
     except (ValueError, IndexError):
         single_page_out = None
+    jobs_parser = argparse.ArgumentParser(add_help=False)
+    jobs_parser.add_argument('--jobs', type=int)
+    jobs = jobs_parser.parse_known_args()[0].jobs or config.get('jobs') or 1
+    try:
+        profile_i = sys.argv.index('--profile')
+        profile_path = sys.argv[profile_i + 1]
+    except (ValueError, IndexError):
+        profile_path = None
     
     debug_mode = "debug" in sys.argv
+    if profile_path is not None and (debug_mode or single_page or "watch" in sys.argv):
+        raise ConfigError("--profile only profiles a single build")
     netlify_key = config.get('netlify-key')
     netlify_site_id = config.get('netlify-site-id')
     
     state = State(config)
+    state.jobs = jobs
     
-    image_ext = ImageSrc(config)
+    image_ext = ImageSrc(config, redis=state.get_redis())
     state.other['image_ext'] = image_ext
-    prerenderer = PreRenderer({'image': image_ext})
-    config.page_renderer = PageRenderer(config, prerenderer=prerenderer)
+    prerenderer = PreRenderer({'image': image_ext, 'image-srcset': image_ext})
+    config.page_renderer = PageRenderer(config, prerenderer=prerenderer, cache=open_render_cache(state))
     
     if single_page:
         
@@ -354,12 +563,30 @@ def main():
         with open_fs("osfs://static") as static_fs:
             fs.copy.copy_fs(static_fs, test_fs)
         
-        def single_page_cb(page_id, *, inner_only=False):
-            res = gen_single_page(state, page_id, inner_only=inner_only)
-            return res['data']
-        
         from single_page import single_page_server
-        single_page_server.start_single_page_server(test_fs, single_page_cb, config['debug-server-port'], debug=debug_mode)
+        from single_page.tree_cache import SeriesTreeCache
+        tree_cache = SeriesTreeCache(
+            state, config.get('single-page-tree-cache') or 8,
+            revalidate_interval=config.get('single-page-tree-revalidate') or 0,
+        )
+        
+        def fetch_cb(page_id):
+            fetched = fetch_single_page(state, page_id)
+            if fetched is None:
+                return None
+            raw_page, raw_series = fetched
+            return raw_page, raw_series, tree_cache.fingerprint(raw_series)
+        
+        def prepare_cb(fetched, *, inner_only=False):
+            page = tree_cache.preview_page(*fetched)
+            etag = single_page_etag(state, page, inner_only=inner_only)
+            return etag, lambda: page.render(inner_only=inner_only)
+        
+        single_page_server.start_single_page_server(
+            test_fs, fetch_cb, prepare_cb, config['debug-server-port'], debug=debug_mode,
+            fetch_workers=config.get('single-page-fetch-workers') or 4,
+            concurrency=config.get('single-page-concurrency') or 16,
+        )
         
         state.close()
         return
@@ -379,17 +606,32 @@ def main():
     else:
         present_series = {}
     
-    series_list = retrieve_series(state)
-    all_pages, series_list, uuid_hashes = retrieve_pages(state, series_list, present_series)
+    if "watch" in sys.argv:
+        if debug_mode:
+            raise ConfigError("watch can't be used with debug")
+        import watch
+        try:
+            watch.watch(state, deploy_target, present_series)
+        finally:
+            state.close()
+        return
     
-    if uuid_hashes == present_series:
-        print("NOTHING TO DO")
+    if profile_path is None:
+        run_build(state, deploy_target, present_series)
         state.close()
         return
     
-    deploy_target.gen_fs(all_pages, series_list)
-    deploy_target.post_gen(uuid_hashes)
-    state.close()
+    profiler = instrument.Profiler(trace_memory='--profile-memory' in sys.argv)
+    profiler.instrument(config.page_renderer)
+    profiler.start()
+    try:
+        with profiler.stage("build"):
+            run_build(state, deploy_target, present_series)
+    finally:
+        profiler.stop()
+        state.close()
+    folded_path = profiler.write(profile_path)
+    print("profile written to {} and {}".format(profile_path, folded_path))
 
 if __name__ == '__main__':
     main()
@@ -1,10 +1,14 @@
 
 import json
+import os
 
 from fs import open_fs
 from fs.errors import CreateFailed
 
+from asset_sync import sync_static
 import debug_server
+from file_watch import FileWatcher
+from .lazy_pages import LazyPages
 
 class DebugServer:
     def __init__(self, state):
@@ -15,15 +19,20 @@ class DebugServer:
         self.fs = None
         self._present_series = None
         self._regen_data = None
+        
+        self.lazy_pages = None
+        if self.config.get('debug-lazy-render'):
+            self.lazy_pages = LazyPages(state, self.config.get('debug-lazy-cache-size') or 500)
     
     def present_series(self):
         return {}
     
-    def gen_fs(self, all_pages, series_list, *, rebuild=False):
+    def gen_fs(self, all_pages, series_list, *, rebuild=False, incremental=False):
         state = self.state
         config = self.config
         
         self._regen_data = all_pages, series_list
+        lazy_pages = self.lazy_pages
         
         osfs_url = "mem://{}".format(config['output-path'])
         if self.fs is None:
@@ -35,9 +44,12 @@ class DebugServer:
             out_fs.makedir(config.url_prefix, recreate=True)
             out_fs = out_fs.opendir(config.url_prefix)
         
-            gen_fs(out_fs, all_pages, series_list, config, state, include_static=not rebuild)
+            gen_fs(out_fs, all_pages, series_list, config, state, include_static=not rebuild, incremental=incremental, write_pages=lazy_pages is None)
         else:
-            gen_fs(out_fs, all_pages, series_list, config, state, include_static=not rebuild)
+            gen_fs(out_fs, all_pages, series_list, config, state, include_static=not rebuild, incremental=incremental, write_pages=lazy_pages is None)
+        
+        if lazy_pages is not None:
+            lazy_pages.set_trees(all_pages, out_fs)
         
         if state.other.get('tree'):
             out_fs.tree()
@@ -52,12 +64,16 @@ class DebugServer:
         def regen():
             config.load_config()
             config.page_renderer.load_templates()
+            config.page_renderer.invalidate_navigation()
             all_pages, series_list = self._regen_data
-            self.gen_fs(all_pages, series_list)
+            # only pages whose hash changed are rendered again
+            self.gen_fs(all_pages, series_list, incremental=True)
         def p_reload():
             config.load_config()
             state.other['image_ext'].force_reload()
+            config.page_renderer.forget_prepared()
             config.page_renderer.load_templates()
+            config.page_renderer.invalidate_navigation()
             series_list = retrieve_series(state)
             if not state.partial_build:
                 self._present_series = {}
@@ -67,5 +83,50 @@ class DebugServer:
         def print_tree():
             self.fs.tree()
         
+        def in_dir(path, dir_path):
+            return os.path.abspath(path).startswith(os.path.abspath(dir_path) + os.sep)
+        
+        def live_regen(changed):
+            """Regenerates what depends on the changed files"""
+            image_folder = config['image-folder']
+            if any(in_dir(path, 'config') for path in changed):
+                # config can change which series and pages are included
+                p_reload()
+                return
+            if all(in_dir(path, 'static') for path in changed):
+                # no page depends on static files
+                out_fs = self.fs.opendir(config.url_prefix) if config.url_prefix else self.fs
+                with open_fs("osfs://static") as static_fs:
+                    sync_static(static_fs, out_fs)
+                return
+            layouts = [path for path in changed if in_dir(path, 'layouts')]
+            if any(os.path.basename(path).startswith('blog_post.') for path in layouts):
+                # blog posts are rendered into their series tree when it is built
+                p_reload()
+                return
+            if layouts:
+                config.page_renderer.load_templates()
+            if image_folder and any(in_dir(path, image_folder) for path in changed):
+                state.other['image_ext'].reload_image_folder()
+                config.page_renderer.forget_prepared()
+            all_pages, series_list = self._regen_data
+            self.gen_fs(all_pages, series_list, incremental=True)
+        
+        poll_fn = None
+        if config.get('debug-live-reload'):
+            watcher = FileWatcher(['layouts', 'static', 'config', config['image-folder']])
+            def poll():
+                changed = watcher.changes()
+                if not changed:
+                    return False
+                print("changed:", ", ".join(sorted(changed)))
+                live_regen(changed)
+                return True
+            poll_fn = poll
+        
         special_pages = {'/regen': regen, '/reload': p_reload, '/tree': print_tree,}
-        debug_server.start_debug_server(self.fs, config['debug-server-port'], special_pages)
+        debug_server.start_debug_server(
+            self.fs, config['debug-server-port'], special_pages,
+            poll=poll_fn, poll_interval=config.get('debug-watch-interval') or 1,
+            lazy_pages=self.lazy_pages,
+        )
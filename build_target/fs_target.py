@@ -5,6 +5,8 @@ import pickle
 from fs import open_fs
 from fs.errors import CreateFailed
 
+from manifest import BuildManifest
+
 class FileSystem:
     def __init__(self, state):
         self.state = state
@@ -33,6 +35,11 @@ class FileSystem:
             return {}
         
         self.rebuild = bool(lastrun)
+        
+        manifest = cache.get('fs_manifest') if cache and lastrun else None
+        if manifest:
+            self.state.manifest = BuildManifest.loads(manifest)
+        
         return lastrun
     
     def gen_fs(self, all_pages, series_list):
@@ -56,3 +63,4 @@ class FileSystem:
         config = self.config
         if cache:
             cache.set('fs_lastrun', json.dumps(series_uuids))
+            cache.set('fs_manifest', self.state.manifest.dumps())
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+import re
+
+def _normalize(path):
+    # empty prefixes and the series root leave double slashes
+    return re.sub('/+', '/', path)
+
+class LazyPages:
+    """Pages of the debug server, rendered when they are first requested
+        
+        Rendered pages are kept in a cache of max_pages entries, least recently
+        used first out. Entries are checked against the page's hash on every
+        request, so they are rendered again once anything they depend on changes.
+        
+        """
+    def __init__(self, state, max_pages=500):
+        self.state = state
+        self.max_pages = max_pages
+        self._routes = {}
+        self._cache = OrderedDict()
+        self._assets_fs = None
+    
+    def set_trees(self, all_pages, out_fs):
+        """Maps the url of every page in all_pages to its page"""
+        config = self.state.config
+        routes = {}
+        for root in all_pages.values():
+            # the same places gen_fs writes pages to
+            series_dir = root.series.path_part if config.series_prefix else ''
+            prefix = "/{}/{}/".format(config.url_prefix or '', series_dir)
+            for page in root.recurse():
+                routes[_normalize("{}{}/".format(prefix, page.get_out_path()))] = page
+        self._routes = routes
+        self._assets_fs = out_fs.makedir('assets', recreate=True)
+        for path in list(self._cache):
+            if path not in routes:
+                del self._cache[path]
+    
+    def has_page(self, uri):
+        return self._split_uri(uri)[1] is not None
+    
+    def _split_uri(self, uri):
+        path = _normalize(uri.split('?', 1)[0])
+        page = self._routes.get(path)
+        if page is not None:
+            return path, page, 'index.html'
+        for file_name in ('index.html', 'raw.md', 'raw/index.html', 'raw/'):
+            if path.endswith('/' + file_name):
+                page_path = path[:-len(file_name)]
+                page = self._routes.get(page_path)
+                if page is not None:
+                    return page_path, page, file_name
+        return None, None, None
+    
+    def get(self, uri):
+        """Content of the page file at uri, None if uri isn't a page"""
+        path, page, file_name = self._split_uri(uri)
+        if page is None:
+            return None
+        if file_name != 'index.html':
+            if page.is_index or not page.config['include-raw']:
+                return None
+            if file_name == 'raw.md':
+                return page.content
+            return "<pre>" + page.content + "</pre>"
+        return self.render(path, page)
+    
+    def render(self, path, page):
+        image_ext = self._image_ext()
+        used_before = self._used_images(image_ext)
+        
+        page_hash = page.config.page_renderer.page_hash(page)
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == page_hash:
+            self._cache.move_to_end(path)
+            html = cached[1]
+        else:
+            html = page.render()
+            self._cache[path] = (page_hash, html)
+            self._cache.move_to_end(path)
+            while len(self._cache) > self.max_pages:
+                self._cache.popitem(last=False)
+        
+        # copy images the first time a page using them is shown
+        if image_ext is not None and self._used_images(image_ext) != used_before:
+            image_ext.add_assets(self._assets_fs)
+        return html
+    
+    def _image_ext(self):
+        page_renderer = self.state.config.page_renderer
+        if page_renderer is None or page_renderer.prerenderer is None:
+            return None
+        return page_renderer.prerenderer.extensions.get('image')
+    
+    def _used_images(self, image_ext):
+        if image_ext is None:
+            return 0
+        return len(image_ext.used_images) + len(image_ext.used_variants)
@@ -1,8 +1,13 @@
 
 import json
+import os
 
-from fs import open_fs
 from fs.errors import CreateFailed
+from fs.tempfs import TempFS
+import fs.path
+
+from manifest import BuildManifest
+from page import page_files
 
 class Netlify:
     def __init__(self, state):
@@ -13,8 +18,11 @@ class Netlify:
         self.lastrun = {
             'series_hashes': {},
             'netlify_hashes': {},
+            'page_hashes': {},
         }
         self.series_hashes = None
+        self.fs = None
+        self._series_list = []
     
     def present_series(self):
         config = self.config
@@ -26,6 +34,7 @@ class Netlify:
             lastrun = json.loads(lastrun)
             self.lastrun = lastrun
         
+        self.state.manifest = BuildManifest(self.lastrun.get('page_hashes'))
         return self.lastrun['series_hashes']
     
     def _remove_old_hashes(self, series_list):
@@ -49,8 +58,14 @@ class Netlify:
         config = self.config
         
         self._remove_old_hashes(series_list)
+        self._series_list = series_list
+        state.manifest.retain([series.id for series in series_list])
         
-        out_fs = open_fs("mem://")
+        # render to a temporary directory instead of memory, the deploy
+        # only reads files back when netlify doesn't have them yet
+        if self.fs is not None:
+            self.fs.close()
+        out_fs = TempFS(identifier='netlify')
         self.fs = out_fs
         
         from build import gen_fs
@@ -58,9 +73,77 @@ class Netlify:
             out_fs.makedir(config.url_prefix, recreate=True)
             out_fs = out_fs.opendir(config.url_prefix)
         
-            gen_fs(out_fs, all_pages, series_list, config, state)
+            removed = gen_fs(out_fs, all_pages, series_list, config, state)
         else:
-            gen_fs(out_fs, all_pages, series_list, config, state)
+            removed = gen_fs(out_fs, all_pages, series_list, config, state)
+        
+        # unchanged pages aren't rendered and keep their old hashes, drop the ones of removed pages
+        netlify_hashes = self.lastrun['netlify_hashes']
+        for path in removed:
+            netlify_hashes.pop(fs.path.join('/', config.url_prefix or '', path), None)
+    
+    def _file_fingerprints(self):
+        """Fingerprints of generated files that are known without reading them
+            
+            Pages use their manifest hash, static files and assets the size and
+            mtime of their source file and image variants their file name.
+            
+            """
+        config = self.config
+        prefix = fs.path.join('/', config.url_prefix or '')
+        fingerprints = {}
+        
+        def stat_fingerprint(os_path):
+            stat = os.stat(os_path)
+            return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+        
+        page_hashes = self.state.manifest.current
+        for series in self._series_list:
+            series_dir = series.path_part if config.series_prefix else ''
+            for page_path, page_hash in page_hashes.get(series.id, {}).items():
+                for file_name in page_files:
+                    fingerprints[fs.path.join(prefix, series_dir, page_path, file_name)] = page_hash
+        
+        for dir_path, _, file_names in os.walk('static'):
+            for file_name in file_names:
+                os_path = os.path.join(dir_path, file_name)
+                path = fs.path.join(prefix, os.path.relpath(os_path, 'static').replace(os.sep, '/'))
+                fingerprints[path] = stat_fingerprint(os_path)
+        
+        image_folder = config['image-folder']
+        if image_folder:
+            for file_name in os.listdir(image_folder):
+                fingerprints[fs.path.join(prefix, 'assets', file_name)] = stat_fingerprint(os.path.join(image_folder, file_name))
+        
+        # variant file names already contain a hash of their content
+        image_ext = self.state.other.get('image_ext')
+        if image_ext is not None and image_ext.variants is not None:
+            for file_name in os.listdir(image_ext.variants.cache_path):
+                fingerprints[fs.path.join(prefix, 'assets', 'variants', file_name)] = file_name
+        
+        return fingerprints
+    
+    def _hash_files(self):
+        """sha1 of every generated file, reusing the digest from the last deploy
+        when a file's fingerprint hasn't changed"""
+        from netlify import file_sha1
+        
+        fingerprints = self._file_fingerprints()
+        digests = self.lastrun.get('digests', {})
+        
+        file_hashes = {}
+        for path in self.fs.walk.files():
+            fingerprint = fingerprints.get(path)
+            cached = digests.get(path)
+            if fingerprint is not None and cached and cached[0] == fingerprint:
+                file_hashes[path] = cached[1]
+            else:
+                file_hashes[path] = file_sha1(self.fs, path)
+            if fingerprint is not None:
+                digests[path] = [fingerprint, file_hashes[path]]
+        
+        self.lastrun['digests'] = digests
+        return file_hashes
     
     def post_gen(self, series_uuids):
         config = self.config
@@ -70,11 +153,33 @@ class Netlify:
         netlify_site_id = config.get('netlify-site-id')
         
         from netlify import Netlify
-        netlify = Netlify(netlify_key, netlify_site_id)
-        _, file_hashes = netlify.deploy_fs(self.fs, self.lastrun['netlify_hashes'])
+        netlify = Netlify(
+            netlify_key,
+            netlify_site_id,
+            api_url=config.get('netlify-api-url'),
+            workers=config.get('netlify-upload-workers') or 8,
+            retries=config.get('netlify-upload-retries') or 0,
+        )
         
         lastrun = self.lastrun
+        
+        # remember the deploy before uploading so an interrupted deploy can be resumed
+        def on_deploy(pending_deploy):
+            lastrun['pending_deploy'] = pending_deploy
+            if cache:
+                cache.set('netlify_lastrun', json.dumps(lastrun))
+        
+        # netlify_hashes gets updated in place, keep the last deployed hashes around for the pending deploy
+        existing_hashes = dict(lastrun['netlify_hashes'])
+        _, file_hashes = netlify.deploy_hashes(self._hash_files(), self.fs.getbytes, existing_hashes, lastrun.get('pending_deploy'), on_deploy)
+        
         lastrun['series_hashes'] = series_uuids
         lastrun['netlify_hashes'] = file_hashes
+        lastrun['page_hashes'] = self.state.manifest.snapshot()
+        lastrun['digests'] = {path: d for path, d in lastrun['digests'].items() if path in file_hashes}
+        lastrun.pop('pending_deploy', None)
         if cache:
             cache.set('netlify_lastrun', json.dumps(lastrun))
+        
+        self.fs.close()
+        self.fs = None
@@ -1,12 +1,54 @@
 import tornado.ioloop
 import tornado.web
-from fs.errors import FileExpected, ResourceNotFound
+import tornado.websocket
 
-def start_debug_server(debug_fs, port=8000, special=None):
+from static_files import StaticFiles
+
+# added to html pages when live reload is on, reloads the page when the server says so
+_live_reload_script = b"""<script>
+(function() {
+    var ws = new WebSocket((location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host + '/_livereload');
+    ws.onmessage = function() { location.reload(); };
+})();
+</script>
+"""
+
+def _inject_live_reload(html):
+    if isinstance(html, str):
+        html = html.encode('utf8')
+    i = html.rfind(b'</body>')
+    if i == -1:
+        return html + _live_reload_script
+    return html[:i] + _live_reload_script + html[i:]
+
+def start_debug_server(debug_fs, port=8000, special=None, *, poll=None, poll_interval=1, lazy_pages=None):
+    """Serves debug_fs
+        
+        poll - optional function called every poll_interval seconds, when it
+            returns True open pages are told to reload over a websocket
+        lazy_pages - optional LazyPages rendering pages that aren't in debug_fs
+        
+        """
     if special is None:
         special = {}
+    live_reload = poll is not None
+    live_sockets = set()
+    static_files = StaticFiles()
+    
+    class LiveReloadHandler(tornado.websocket.WebSocketHandler):
+        def open(self):
+            live_sockets.add(self)
+        
+        def on_close(self):
+            live_sockets.discard(self)
+    
     class DebugHandler(tornado.web.RequestHandler):
-        def get(self):
+        def finish_html(self, html):
+            if live_reload:
+                html = _inject_live_reload(html)
+            self.finish(html)
+        
+        async def get(self):
             print(self.request.uri)
             uri = self.request.uri
             
@@ -15,28 +57,33 @@ def start_debug_server(debug_fs, port=8000, special=None):
                 self.finish(str(special_f()))
                 return
             
-            if uri == '/':
-                self.finish(debug_fs.open("/index.html").read())
-                return
-            try:
-                if uri.endswith('.css'):
-                    self.set_header('Content-Type', 'text/css')
-                if uri.endswith('.jpg'):
-                    self.set_header('Content-Type', 'image/jpg')
-                #self.finish(debug_fs.open(uri).read())
-                self.finish(debug_fs.getbytes(uri))
-            except FileExpected:
-                if not uri.endswith('/'):
-                    self.redirect('{}/'.format(uri), True)
+            path = uri.split('?', 1)[0]
+            if lazy_pages is not None:
+                data = lazy_pages.get(path)
+                if data is not None:
+                    if path.endswith('.md'):
+                        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+                        self.finish(data)
+                    else:
+                        self.finish_html(data)
+                    return
+                if not path.endswith('/') and lazy_pages.has_page(path + '/'):
+                    self.redirect('{}/'.format(path), True)
                     return
-                self.finish(debug_fs.open(uri + "/index.html").read())
-            except ResourceNotFound:
-                self.set_status(404)
-                self.finish()
             
+            transform_html = _inject_live_reload if live_reload else None
+            await static_files.send(self, debug_fs, path, transform_html=transform_html)
+    
+    def check_for_changes():
+        if poll():
+            for socket in list(live_sockets):
+                socket.write_message('reload')
     
     app = tornado.web.Application([
+        (r"/_livereload", LiveReloadHandler),
         (r"/.*", DebugHandler),
     ], debug=True)
     app.listen(port)
+    if live_reload:
+        tornado.ioloop.PeriodicCallback(check_for_changes, poll_interval * 1000).start()
     tornado.ioloop.IOLoop.current().start()
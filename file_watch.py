@@ -0,0 +1,76 @@
+import os
+import threading
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+def _scan(paths):
+    snapshot = {}
+    for root_path in paths:
+        if os.path.isfile(root_path):
+            stat = os.stat(root_path)
+            snapshot[root_path] = (stat.st_size, stat.st_mtime_ns)
+            continue
+        for dir_path, _, file_names in os.walk(root_path):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+class FileWatcher:
+    """Reports files that were added, changed or removed under paths since the last check
+        
+        Uses watchdog (inotify on linux) when it is installed, otherwise every
+        check compares the size and mtime of all files with the last check.
+        
+        """
+    def __init__(self, paths):
+        self.paths = [os.path.normpath(path) for path in paths if path and os.path.exists(path)]
+        self._observer = None
+        self._changed = set()
+        self._lock = threading.Lock()
+        
+        if Observer is not None:
+            watcher = self
+            class Handler(FileSystemEventHandler):
+                def on_any_event(self, event):
+                    # watchdog also reports files being opened and closed
+                    if event.is_directory or event.event_type not in ('created', 'modified', 'moved', 'deleted'):
+                        return
+                    with watcher._lock:
+                        watcher._changed.add(event.src_path)
+                        dest_path = getattr(event, 'dest_path', None)
+                        if dest_path:
+                            watcher._changed.add(dest_path)
+            
+            self._observer = Observer()
+            for path in self.paths:
+                self._observer.schedule(Handler(), path, recursive=True)
+            self._observer.daemon = True
+            self._observer.start()
+        else:
+            self._snapshot = _scan(self.paths)
+    
+    def changes(self):
+        """Set of paths changed since the last call"""
+        if self._observer is not None:
+            with self._lock:
+                changed = self._changed
+                self._changed = set()
+            return changed
+        
+        snapshot = _scan(self.paths)
+        old_snapshot = self._snapshot
+        self._snapshot = snapshot
+        return {path for path in snapshot.keys() | old_snapshot.keys() if snapshot.get(path) != old_snapshot.get(path)}
+    
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
@@ -0,0 +1,165 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# bump when the way variants are generated changes, so cached ones are regenerated
+_variant_version = 1
+
+_formats = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+}
+
+def _save(img, path, fmt, quality):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    if fmt == 'JPEG':
+        img.convert('RGB').save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    elif fmt == 'PNG':
+        img.save(tmp_path, 'PNG', optimize=True)
+    else:
+        img.save(tmp_path, fmt, quality=quality)
+    os.replace(tmp_path, path)
+
+def _make_variants(src_path, jobs, quality):
+    """Writes the resized copies of one image, jobs is a list of (width, format, cache path)"""
+    with Image.open(src_path) as img:
+        img.load()
+        for width, fmt, path in jobs:
+            height = max(1, round(img.height * width / img.width))
+            _save(img.resize((width, height), Image.LANCZOS), path, fmt, quality)
+
+class ImageVariants:
+    """Resized and recompressed copies of images, for srcset
+        
+        Variants are stored in cache_path named by a hash of the source image's
+        content and the settings used, so each one is only generated once. An
+        index of source image size/mtime to content hash and dimensions avoids
+        reading unchanged images again.
+        
+        """
+    def __init__(self, image_folder, cache_path, *, widths, quality=80, webp=True, workers=None):
+        self.image_folder = image_folder
+        self.cache_path = cache_path
+        self.widths = sorted(widths)
+        self.quality = quality
+        self.webp = webp
+        self.workers = workers
+        
+        os.makedirs(cache_path, exist_ok=True)
+        self._index_path = os.path.join(cache_path, 'index.json')
+        try:
+            with open(self._index_path, encoding='utf8') as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+        self._index_changed = False
+    
+    @classmethod
+    def from_config(cls, config):
+        """ImageVariants configured by image-variants, None if disabled or Pillow isn't installed"""
+        variant_config = config.get('image-variants') or {}
+        if not variant_config.get('enabled') or not config['image-folder']:
+            return None
+        if Image is None:
+            print("image-variants is enabled but Pillow isn't installed, images are used as is")
+            return None
+        return cls(
+            config['image-folder'],
+            variant_config.get('cache-path') or '.image_cache',
+            widths=variant_config.get('widths') or [480, 960, 1600],
+            quality=variant_config.get('quality') or 80,
+            webp=bool(variant_config.get('webp')),
+            workers=variant_config.get('workers'),
+        )
+    
+    def info(self, file_name):
+        """{'digest', 'width', 'height', 'format'} of an image in image_folder"""
+        src_path = os.path.join(self.image_folder, file_name)
+        stat = os.stat(src_path)
+        stat_key = "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+        
+        entry = self._index.get(file_name)
+        if entry is not None and entry['stat'] == stat_key:
+            return entry
+        
+        m = hashlib.sha1()
+        with open(src_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                m.update(chunk)
+        with Image.open(src_path) as img:
+            width, height = img.size
+            fmt = img.format
+        
+        entry = {
+            'stat': stat_key,
+            'digest': m.hexdigest(),
+            'width': width,
+            'height': height,
+            'format': fmt,
+        }
+        self._index[file_name] = entry
+        self._index_changed = True
+        return entry
+    
+    def variants(self, file_name):
+        """List of (file name, width, mime type) for an image
+            
+            File names include a hash of the image's content and the settings
+            used, so they can be served with long cache lifetimes.
+            
+            """
+        entry = self.info(file_name)
+        fmt = entry['format']
+        formats = []
+        if fmt in _formats:
+            formats.append((fmt, _formats[fmt], 'image/{}'.format(fmt.lower())))
+        if self.webp:
+            formats.append(('WEBP', 'webp', 'image/webp'))
+        
+        variants = []
+        for width in self.widths:
+            if width >= entry['width']:
+                break
+            for fmt, ext, mime in formats:
+                settings = "{}:{}:{}:{}".format(_variant_version, width, fmt, self.quality)
+                cache_name = "{}-{}.{}".format(entry['digest'], hashlib.sha1(settings.encode()).hexdigest()[:12], ext)
+                variants.append((cache_name, width, mime))
+        return variants
+    
+    def generate(self, file_names):
+        """Generates the variants of file_names that aren't cached yet, in a process pool"""
+        tasks = []
+        for file_name in file_names:
+            jobs = []
+            for cache_name, width, mime in self.variants(file_name):
+                path = os.path.join(self.cache_path, cache_name)
+                if not os.path.exists(path):
+                    fmt = mime.split('/')[1].upper()
+                    jobs.append((width, fmt, path))
+            if jobs:
+                tasks.append((os.path.join(self.image_folder, file_name), jobs))
+        
+        if tasks:
+            with ProcessPoolExecutor(self.workers) as executor:
+                futures = [executor.submit(_make_variants, src_path, jobs, self.quality) for src_path, jobs in tasks]
+                for (src_path, _), future in zip(tasks, futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print("couldn't generate variants of {}: {}".format(src_path, e))
+        self.save_index()
+    
+    def save_index(self):
+        if not self._index_changed:
+            return
+        tmp_path = "{}.{}.tmp".format(self._index_path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+        self._index_changed = False
@@ -0,0 +1,210 @@
+"""Build profiling
+
+A Profiler records wall time, cpu time, allocations and output bytes for
+each stage of a build, and for each page the time spent in prerendering,
+markdown, navigation and templates. Stages are marked with
+instrument.stage(name), which does nothing unless a profiler is running.
+
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import sys
+import time
+import tracemalloc
+
+# the running profiler, if any
+_profiler = None
+
+_page_parts = ('prerender', 'markdown', 'nav', 'template')
+
+@contextmanager
+def stage(name):
+    if _profiler is None:
+        yield
+        return
+    with _profiler.stage(name):
+        yield
+
+def forget_pages():
+    """Drops page timings inherited by a forked worker, so only its own are sent back"""
+    if _profiler is not None:
+        _profiler.pages = OrderedDict()
+
+def take_page_timings():
+    """Page timings recorded in this process since the last call, None if not profiling"""
+    if _profiler is None:
+        return None
+    pages = list(_profiler.pages.values())
+    _profiler.pages = OrderedDict()
+    return pages
+
+def add_page_timings(pages):
+    """Adds page timings sent back by a worker"""
+    if _profiler is None or not pages:
+        return
+    for page in pages:
+        record = _profiler.pages.get((page['series'], page['path']))
+        if record is None:
+            _profiler.pages[(page['series'], page['path'])] = page
+        else:
+            for key in ('total', 'bytes') + _page_parts:
+                record[key] += page[key]
+        _profiler.add_bytes(page['bytes'])
+
+class Profiler:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.pages = OrderedDict()
+        self._stack = []
+        self._page = None
+        self._part = None
+    
+    def start(self):
+        global _profiler
+        _profiler = self
+        if self.trace_memory:
+            tracemalloc.start()
+    
+    def stop(self):
+        global _profiler
+        _profiler = None
+        if self.trace_memory:
+            tracemalloc.stop()
+    
+    @contextmanager
+    def stage(self, name):
+        record = {
+            'name': ";".join([s['short_name'] for s in self._stack] + [name]),
+            'short_name': name,
+            'output_bytes': 0,
+            'children_wall': 0,
+        }
+        self._stack.append(record)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        blocks = sys.getallocatedblocks()
+        if self.trace_memory:
+            memory = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+            record['allocated_blocks'] = sys.getallocatedblocks() - blocks
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record['allocated_bytes'] = current - memory
+                record['peak_bytes'] = peak - memory
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1]['children_wall'] += record['wall']
+            self.stages.append(record)
+    
+    def add_bytes(self, count):
+        for record in self._stack:
+            record['output_bytes'] += count
+    
+    def _page_record(self, page):
+        key = (page.series.name, page.get_out_path())
+        record = self.pages.get(key)
+        if record is None:
+            record = {'series': key[0], 'path': key[1], 'total': 0, 'bytes': 0}
+            record.update((part, 0) for part in _page_parts)
+            self.pages[key] = record
+        return record
+    
+    def _timed_page(self, method, counts_output):
+        def timed(page, *args, **kwargs):
+            if self._page is not None:
+                return method(page, *args, **kwargs)
+            record = self._page_record(page)
+            self._page = record
+            start = time.perf_counter()
+            try:
+                result = method(page, *args, **kwargs)
+            finally:
+                record['total'] += time.perf_counter() - start
+                self._page = None
+            if counts_output:
+                count = len(result.encode('utf8'))
+                record['bytes'] += count
+                self.add_bytes(count)
+            return result
+        return timed
+    
+    def _timed_part(self, part, method):
+        def timed(*args, **kwargs):
+            record = self._page
+            if record is None or self._part is not None:
+                return method(*args, **kwargs)
+            self._part = part
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                record[part] += time.perf_counter() - start
+                self._part = None
+        return timed
+    
+    def instrument(self, page_renderer):
+        """Wraps the methods of page_renderer that pages are timed by"""
+        page_renderer.page_hash = self._timed_page(page_renderer.page_hash, False)
+        page_renderer.render = self._timed_page(page_renderer.render, True)
+        page_renderer.prerender = self._timed_part('prerender', page_renderer.prerender)
+        page_renderer.content_digest = self._timed_part('prerender', page_renderer.content_digest)
+        page_renderer.get_navigation = self._timed_part('nav', page_renderer.get_navigation)
+        page_renderer.get_navigation_digest = self._timed_part('nav', page_renderer.get_navigation_digest)
+        page_renderer.render_template = self._timed_part('template', page_renderer.render_template)
+        page_renderer.markdown.convert = self._timed_part('markdown', page_renderer.markdown.convert)
+    
+    def report(self, slowest=50):
+        stages = []
+        for record in self.stages:
+            record = {k: v for k, v in record.items() if k not in ('short_name', 'children_wall')}
+            stages.append(record)
+        
+        series = OrderedDict()
+        for page in self.pages.values():
+            totals = series.get(page['series'])
+            if totals is None:
+                totals = {'series': page['series'], 'pages': 0, 'total': 0, 'bytes': 0}
+                totals.update((part, 0) for part in _page_parts)
+                series[page['series']] = totals
+            totals['pages'] += 1
+            for key in ('total', 'bytes') + _page_parts:
+                totals[key] += page[key]
+        
+        return {
+            'stages': stages,
+            'series': sorted(series.values(), key=lambda s: s['total'], reverse=True),
+            'slowest_pages': sorted(self.pages.values(), key=lambda p: p['total'], reverse=True)[:slowest],
+        }
+    
+    def folded(self):
+        """Stacks in the folded format of flamegraph.pl/speedscope, weighted in microseconds"""
+        lines = []
+        for record in self.stages:
+            self_time = record['wall'] - record['children_wall']
+            lines.append("{} {}".format(record['name'], int(self_time * 1000000)))
+        for page in self.pages.values():
+            stack = "pages;{};{}".format(page['series'], page['path'] or '/')
+            other = page['total'] - sum(page[part] for part in _page_parts)
+            for part in _page_parts + ('other',):
+                duration = other if part == 'other' else page[part]
+                if duration > 0:
+                    lines.append("{};{} {}".format(stack, part, int(duration * 1000000)))
+        return "\n".join(lines) + "\n"
+    
+    def write(self, path):
+        """Writes the json report to path and the folded stacks next to it"""
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump(self.report(), f, indent=1)
+        folded_path = (path[:-5] if path.endswith('.json') else path) + '.folded'
+        with open(folded_path, 'w', encoding='utf8') as f:
+            f.write(self.folded())
+        return folded_path
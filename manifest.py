@@ -0,0 +1,48 @@
+import json
+
+class BuildManifest:
+    """Tracks a hash per generated page so unchanged pages can be skipped
+        
+        previous/current - {series_id: {page_path: page_hash}}
+        
+        """
+    def __init__(self, previous=None):
+        self.previous = previous or {}
+        self.current = {}
+    
+    @classmethod
+    def loads(cls, data):
+        return cls(json.loads(data))
+    
+    def dumps(self):
+        return json.dumps(self.snapshot())
+    
+    def snapshot(self):
+        return {**self.previous, **self.current}
+    
+    def commit(self):
+        """Makes the hashes recorded so far the baseline for the next build"""
+        self.previous = self.snapshot()
+        self.current = {}
+    
+    def clear(self):
+        self.previous = {}
+        self.current = {}
+    
+    def retain(self, series_ids):
+        """Forgets every series not in series_ids"""
+        self.previous = {k: v for k, v in self.previous.items() if k in series_ids}
+        self.current = {k: v for k, v in self.current.items() if k in series_ids}
+    
+    def has_series(self, series_id):
+        return series_id in self.previous
+    
+    def update(self, series_id, page_path, page_hash):
+        """Records the hash of a page, returns True if the page needs to be written"""
+        self.current.setdefault(series_id, {})[page_path] = page_hash
+        return self.previous.get(series_id, {}).get(page_path) != page_hash
+    
+    def stale_pages(self, series_id):
+        """Paths of pages that were generated last build but no longer exist"""
+        current = self.current.get(series_id, {})
+        return [path for path in self.previous.get(series_id, {}) if path not in current]
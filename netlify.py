@@ -1,36 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import hashlib
+import json
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+
+class UploadError(Exception):
+    def __init__(self, deploy_id, failed):
+        super().__init__("{} files failed to upload to deploy {}".format(len(failed), deploy_id))
+        self.deploy_id = deploy_id
+        self.failed = failed
 
 class Netlify:
-    def __init__(self, key, site_id=None):
-        pass
-        self.host = 'api.netlify.com/api/v1'
+    def __init__(self, key, site_id=None, *, api_url=None, workers=8, retries=3, backoff=1, timeout=60):
+        self.api_url = api_url or 'https://api.netlify.com/api/v1'
         self.key = key
         self.site_id = site_id
         self.deploy_id = None
+        
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        
+        # one pooled session so uploads reuse connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max(workers, 10))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
     
     def _make_url(self, path):
         key = self.key
         url_end = '?access_token={}'.format(key)
-        url = 'https://{}/{}{}'.format(self.host, path, url_end)
+        url = '{}/{}{}'.format(self.api_url, path, url_end)
         return url
     
     def _get(self, path):
         url = self._make_url(path)
-        res = requests.get(url)
+        res = self.session.get(url, timeout=self.timeout)
         return res
     
     def _post(self, path, data=None, json=None):
         url = self._make_url(path)
-        res = requests.post(url, data=data, json=json)
+        res = self.session.post(url, data=data, json=json, timeout=self.timeout)
         return res
     
     def _put_file(self, path, data=None):
+        """Uploads a file, retrying with exponential backoff on connection and server errors"""
         url = self._make_url(path)
         headers = {'Content-type': 'application/octet-stream'}
-        res = requests.put(url, data=data, headers=headers)
-        return res
+        attempt = 0
+        while True:
+            try:
+                res = self.session.put(url, data=data, headers=headers, timeout=self.timeout)
+                if res.status_code < 500 and res.status_code != 429:
+                    res.raise_for_status()
+                    return res
+                error = requests.HTTPError("{} uploading {}".format(res.status_code, path), response=res)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            
+            if attempt >= self.retries:
+                raise error
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
     
     def sites(self):
         res = self._get('sites')
@@ -42,49 +76,108 @@ class Netlify:
     
     def deploy(self, files):
         files = {'files': files}
-        res = self._post('sites/{}/deploys'.format(site_id), json=files)
+        res = self._post('sites/{}/deploys'.format(self.site_id), json=files)
         data = res.json()
         self.deploy_id = data['id']
         return data
     
-    def deploy_files(self, files, existing_hashes=None):
+    def _resume_deploy(self, deploy_id):
+        """Returns the deploy if it's still waiting for files, None otherwise"""
+        res = self._get('deploys/{}'.format(deploy_id))
+        if res.status_code != 200:
+            return None
+        deploy_res = res.json()
+        if deploy_res.get('state') != 'uploading':
+            return None
+        return deploy_res
+    
+    def deploy_files(self, files, existing_hashes=None, resume=None, on_deploy=None):
         """Deploys files and sets deploy_id
         
             files - {path: bytes object}
+            resume - pending deploy from an earlier interrupted call, used if
+                it was for the same files
+            on_deploy - called with the pending deploy ({'id', 'digest'})
+                before files are uploaded
         
             """
+        file_hashes = {k: hashlib.sha1(v).hexdigest() for k, v in files.items()}
+        return self.deploy_hashes(file_hashes, files.__getitem__, existing_hashes, resume, on_deploy)
+    
+    def deploy_hashes(self, file_hashes, read_file, existing_hashes=None, resume=None, on_deploy=None):
+        """Deploys files by their sha1 hashes, read_file(path) is only called for files netlify requires"""
         hashes = existing_hashes or {}
-        hashes.update({k: hashlib.sha1(v).hexdigest() for k, v in files.items()})
+        hashes.update(file_hashes)
         
         file_digest = {
             'files': hashes
         }
+        digest = hashlib.sha1(json.dumps(hashes, sort_keys=True).encode()).hexdigest()
         
-        res = self._post('sites/{}/deploys'.format(self.site_id), json=file_digest)
-        deploy_res = res.json()
+        deploy_res = None
+        if resume and resume.get('digest') == digest:
+            deploy_res = self._resume_deploy(resume['id'])
+            if deploy_res is not None:
+                print("resuming deploy", resume['id'])
+        if deploy_res is None:
+            res = self._post('sites/{}/deploys'.format(self.site_id), json=file_digest)
+            res.raise_for_status()
+            deploy_res = res.json()
         
         self.deploy_id = deploy_res['id']
-        required_hashes = deploy_res['required']
-        by_hash = {v: k for k, v in file_digest['files'].items()}
+        if on_deploy is not None:
+            on_deploy({'id': self.deploy_id, 'digest': digest})
+        
+        required_hashes = deploy_res.get('required') or []
+        by_hash = {v: k for k, v in file_hashes.items()}
         
         no_file_hashes = set(required_hashes) - set(by_hash)
         if no_file_hashes:
             print("hashes missing files", no_file_hashes)
             raise ValueError()
         
-        for file_hash in required_hashes:
-            path = by_hash[file_hash]
-            url = "deploys/{}/files{}".format(self.deploy_id, path)
-            self._put_file(url, files[path])
+        self._upload_files([by_hash[file_hash] for file_hash in required_hashes], read_file)
         
         return deploy_res, hashes
     
-    def deploy_fs(self, deploy, existing_hashes=None):
-        files = {
-            path: deploy.getbytes(path)
+    def _upload_files(self, paths, read_file):
+        """Uploads paths to the current deploy using a pool of workers"""
+        def upload(path):
+            url = "deploys/{}/files{}".format(self.deploy_id, path)
+            self._put_file(url, read_file(path))
+        
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(upload, path): path for path in paths}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except requests.RequestException as e:
+                    print("failed to upload", futures[future], e)
+                    failed.append(futures[future])
+        
+        if failed:
+            raise UploadError(self.deploy_id, failed)
+    
+    def deploy_fs(self, deploy, existing_hashes=None, resume=None, on_deploy=None):
+        """Deploys every file in the filesystem deploy
+            
+            Files are hashed in chunks and only read in full again when netlify
+            requires them, so the whole site is never held in memory.
+            
+            """
+        file_hashes = {
+            path: file_sha1(deploy, path)
             for path in deploy.walk.files()
         }
-        return self.deploy_files(files, existing_hashes)
+        return self.deploy_hashes(file_hashes, deploy.getbytes, existing_hashes, resume, on_deploy)
+
+def file_sha1(src_fs, path, chunk_size=64 * 1024):
+    m = hashlib.sha1()
+    with src_fs.openbin(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            m.update(chunk)
+    return m.hexdigest()
 
 def main():
     import argparse
@@ -11,5 +11,5 @@ def page_sort_key_predicate(page):
     
     path_part_str = str(page.path_part)
     
-    order_arr = [order, path_part_int, path_part_str]
+    order_arr = (order, path_part_int, path_part_str)
     return order_arr
@@ -1,7 +1,18 @@
 from ordering import page_sort_key_predicate
 from util import try_int
 
+# files Page.build_fs can write in a page's directory
+page_files = ('index.html', 'raw.md', 'raw/index.html')
+
 class Page:
+    # series can have tens of thousands of pages, slots keep each node small
+    __slots__ = (
+        'children', 'root', 'parent', 'series', 'path', 'path_part',
+        'user_path', 'is_index', 'order', 'renderer', 'hide_nav', 'title',
+        'nav_title', 'content', 'tree_version', 'sort_key',
+        '_fs_parts', '_sorted_children', '_prepared',
+    )
+    
     def __init__(self, page=None, series=None, root=None, parent=None):
         self.children = {}
         if root is None:
@@ -10,9 +21,10 @@ class Page:
             self.root = root
         self.parent = parent
         self.series = series
-        self.config = series.config
-        self.path = []
+        self.path = ()
         self.path_part = None
+        self.tree_version = 0
+        self._fs_parts = None
         self.user_path = None
         self.is_index = True
         self.order = None
@@ -21,8 +33,19 @@ class Page:
         
         self.title = ''
         self.nav_title = None
+        self.content = None
+        self.sort_key = None
+        self._sorted_children = None
+        # set by PageRenderer, the prerendered content and its digest
+        self._prepared = None
         if page is not None:
             self.set_raw_page(page)
+        else:
+            self._update_sort_key()
+    
+    @property
+    def config(self):
+        return self.series.config
     
     def add_page(self, path, page):
         if path == []:
@@ -36,10 +59,13 @@ class Page:
                 cur = cur.children[p]
             else:
                 new_page = Page(root=self.root, series=self.series, parent=cur)
-                new_page.path = list(cur_path)
+                new_page.path = tuple(cur_path)
                 new_page.path_part = p
+                new_page._update_sort_key()
                 cur.children[p] = new_page
+                cur._sorted_children = None
                 cur = new_page
+                self.root.tree_version += 1
         
         cur.set_raw_page(page)
     
@@ -59,10 +85,18 @@ class Page:
                 series = self.series
                 parent = cur
                 
-                new_page.path = list(cur_path)
+                new_page.path = tuple(cur_path)
                 new_page.path_part = p
+                new_page._update_sort_key()
                 cur.children[p] = new_page
+                cur._sorted_children = None
                 cur = new_page
+                self.root.tree_version += 1
+    
+    def set_children(self, children):
+        self.children = children
+        self._sorted_children = None
+        self.root.tree_version += 1
     
     def change_root(self, new_root):
         for p in self.recurse():
@@ -98,8 +132,10 @@ class Page:
     
     def set_raw_page(self, page):
         meta = page.get('meta', {})
+        self.root.tree_version += 1
         
         self.content = str(page['content'])
+        self._prepared = None
         self.title = str(meta.get('title', ''))
         self.renderer = str(meta.get('renderer_t', 'markdown+preproc'))
         self.is_index = False
@@ -111,10 +147,20 @@ class Page:
         if order == "_0":
             order = 0
         self.order = try_int(order, order) or 0
+        self._update_sort_key()
+    
+    def _update_sort_key(self):
+        self.sort_key = page_sort_key_predicate(self)
+        if self.parent is not None:
+            self.parent._sorted_children = None
     
     def get_path(self):
         return self.path
     
+    def get_out_path(self):
+        """Path of the page's directory relative to the series output"""
+        return "/".join(str(p) for p in self.path)
+    
     def get_fs_series_path(self):
         url_prefix = self.config.path_prefix
         series_prefix = self.config.series_prefix
@@ -138,13 +184,21 @@ class Page:
             path = ''
         if url_prefix:
             path = url_prefix + path
-        parts = []
-        cur = self
-        while cur.parent is not None:
-            parts.append(cur.path_part)
-            cur = cur.parent
-        parts = [str(p) for p in parts]
-        return path + "/" + "/".join(reversed(parts)) + "/"
+        return path + "/" + self._get_fs_parts() + "/"
+    
+    def _get_fs_parts(self):
+        # path parts below the series root, memoized since the navigation
+        # asks for the path of every page
+        if self._fs_parts is None:
+            if self.parent is None:
+                self._fs_parts = ''
+            else:
+                parent_parts = self.parent._get_fs_parts()
+                if parent_parts:
+                    self._fs_parts = "{}/{}".format(parent_parts, self.path_part)
+                else:
+                    self._fs_parts = str(self.path_part)
+        return self._fs_parts
     
     def tree(self, depth=0, front=""):
         print(" "*depth, front, self.title if not self.is_index else "_", sep="")
@@ -156,22 +210,30 @@ class Page:
         for c in self:
             yield from c.recurse()
     
-    def build_fs(self, out_fs):
-        with out_fs.open('index.html', 'w') as f:
-            f.write(self.render())
+    def build_fs(self, out_fs, pages=None):
+        """Writes this page and everything below it to out_fs
         
-        if not self.is_index and self.config['include-raw']:
-            content = self.content
-            with out_fs.open('raw.md', 'w') as f:
-                f.write(content)
-            out_fs.makedir('raw', recreate=True)
-            with out_fs.open('raw/index.html', 'w') as f:
-                f.write("<pre>" + content + "</pre>")
+            pages - optional iterable of (page, html) to write instead of rendering the whole tree
         
-        for child in self:
-            p_n = str(child.path_part)
-            out_fs.makedir(p_n, recreate=True)
-            child.build_fs(out_fs.opendir(p_n))
+            """
+        if pages is None:
+            pages = ((page, page.render()) for page in self.recurse())
+        depth = len(self.path)
+        
+        for page, html in pages:
+            page_dir = "/".join(str(p) for p in page.path[depth:])
+            page_fs = out_fs.makedirs(page_dir, recreate=True) if page_dir else out_fs
+            
+            with page_fs.open('index.html', 'w') as f:
+                f.write(html)
+            
+            if not page.is_index and page.config['include-raw']:
+                content = page.content
+                with page_fs.open('raw.md', 'w') as f:
+                    f.write(content)
+                page_fs.makedir('raw', recreate=True)
+                with page_fs.open('raw/index.html', 'w') as f:
+                    f.write("<pre>" + content + "</pre>")
     
     def render(self, *, inner_only=False):
         return self.config.page_renderer.render(self, 'page', 'chapter-inner', inner_only=inner_only)
@@ -185,5 +247,8 @@ class Page:
         return self.children[key]
     
     def __iter__(self):
-        for child in sorted((c[1] for c in self.children.items()), key=page_sort_key_predicate):
-            yield child
+        if not self.children:
+            return iter(())
+        if self._sorted_children is None:
+            self._sorted_children = sorted(self.children.values(), key=lambda c: c.sort_key)
+        return iter(self._sorted_children)
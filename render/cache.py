@@ -0,0 +1,102 @@
+import os
+import time
+import zlib
+
+class DiskRenderCache:
+    """Rendered pages stored as compressed files
+        
+        Reads refresh an entry's mtime, entries past max_entries are evicted
+        least recently used first and entries older than ttl seconds expire.
+        
+        """
+    def __init__(self, path, max_entries=50000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+        os.makedirs(path, exist_ok=True)
+    
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+    
+    def get(self, key):
+        entry_path = self._entry_path(key)
+        try:
+            if self.ttl and time.time() - os.path.getmtime(entry_path) > self.ttl:
+                return None
+            with open(entry_path, 'rb') as f:
+                data = f.read()
+            os.utime(entry_path)
+        except OSError:
+            return None
+        return zlib.decompress(data).decode('utf8')
+    
+    def set(self, key, html):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # write then rename so other processes never read a partial entry
+        tmp_path = "{}.{}.tmp".format(entry_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(html.encode('utf8')))
+        os.replace(tmp_path, entry_path)
+        
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self.evict()
+    
+    def evict(self):
+        entries = []
+        for dir_path, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                entry_path = os.path.join(dir_path, file_name)
+                try:
+                    entries.append((os.path.getmtime(entry_path), entry_path))
+                except OSError:
+                    pass
+        entries.sort()
+        
+        remove = max(0, len(entries) - self.max_entries)
+        if self.ttl:
+            expired = time.time() - self.ttl
+            remove = max(remove, sum(1 for mtime, _ in entries if mtime < expired))
+        for _, entry_path in entries[:remove]:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+
+class RedisRenderCache:
+    """Rendered pages stored compressed in redis, expiring ttl seconds after their last use"""
+    def __init__(self, redis, ttl=None, prefix='render:'):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+    
+    def get(self, key):
+        name = self.prefix + key
+        data = self.redis.get(name)
+        if data is None:
+            return None
+        if self.ttl:
+            self.redis.expire(name, self.ttl)
+        return zlib.decompress(data).decode('utf8')
+    
+    def set(self, key, html):
+        self.redis.set(self.prefix + key, zlib.compress(html.encode('utf8')), ex=self.ttl or None)
+
+def open_render_cache(state):
+    """Render cache configured by render-cache, in redis if redis-url is set, otherwise on disk"""
+    config = state.config
+    cache_config = config.get('render-cache') or {}
+    if not cache_config.get('enabled'):
+        return None
+    
+    ttl = cache_config.get('ttl')
+    redis = state.get_redis()
+    if redis is not None:
+        return RedisRenderCache(redis, ttl=ttl)
+    return DiskRenderCache(
+        cache_config.get('path') or '.render_cache',
+        max_entries=cache_config.get('max-entries') or 50000,
+        ttl=ttl,
+    )
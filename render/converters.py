@@ -0,0 +1,53 @@
+from collections import OrderedDict
+import hashlib
+
+import markdown
+import mistune
+
+class MarkdownConverter:
+    """Markdown to html using one reusable converter per flavour
+        
+        kinds
+            mistune - mistune without escaping html
+            mistune-nohtml - mistune escaping html
+            markdown - python-markdown with footnotes
+        
+        Results are memoized by a hash of the text, keeping the memo_size most
+        recently used ones.
+        
+        """
+    def __init__(self, memo_size=1000):
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        
+        self._mistune = mistune.Markdown(renderer=mistune.Renderer(escape=False))
+        self._mistune_nohtml = mistune.Markdown(escape=True)
+        self._markdown = markdown.Markdown(extensions=['markdown.extensions.footnotes'])
+    
+    def _convert(self, kind, text):
+        if kind == 'mistune':
+            return self._mistune(text)
+        if kind == 'mistune-nohtml':
+            return self._mistune_nohtml(text)
+        if kind == 'markdown':
+            # reset clears footnotes and other state left from the last document
+            self._markdown.reset()
+            return self._markdown.convert(text)
+        raise ValueError("unknown markdown kind {}".format(kind))
+    
+    def convert(self, kind, text):
+        key = (kind, hashlib.sha1(text.encode('utf8')).digest())
+        try:
+            html = self._memo[key]
+        except KeyError:
+            pass
+        else:
+            self._memo.move_to_end(key)
+            return html
+        
+        html = self._convert(kind, text)
+        self._memo[key] = html
+        if len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+        return html
+
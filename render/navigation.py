@@ -1,4 +1,6 @@
 
+import hashlib
+
 from yattag import Doc
 
 from ordering import page_sort_key_predicate
@@ -75,3 +77,39 @@ def gen_nav(root, page):
                 line('a', 'Contact', href='javascript:void(0)')
     
     return doc.getvalue()
+
+class NavigationCache:
+    """Navigation html per series
+        
+        Entries are rebuilt when the series root or its tree_version changes and
+        can be dropped explicitly with invalidate. A digest of the html is kept
+        with it so page hashes don't have to include the whole navigation.
+        
+        """
+    def __init__(self):
+        self._navigation = {}
+    
+    def _entry(self, root):
+        cached = self._navigation.get(root.series.id)
+        if cached is not None:
+            cached_root, tree_version, html, digest = cached
+            if cached_root is root and tree_version == root.tree_version:
+                return cached
+        
+        html = gen_nav(root, root)
+        digest = hashlib.sha256(html.encode()).hexdigest()
+        entry = (root, root.tree_version, html, digest)
+        self._navigation[root.series.id] = entry
+        return entry
+    
+    def get(self, root):
+        return self._entry(root)[2]
+    
+    def digest(self, root):
+        return self._entry(root)[3]
+    
+    def invalidate(self, series_id=None):
+        if series_id is None:
+            self._navigation = {}
+        else:
+            self._navigation.pop(series_id, None)
@@ -0,0 +1,93 @@
+import multiprocessing
+
+import instrument
+
+# pages being rendered, set before the pool is created so forked workers inherit
+# the page trees instead of having them pickled for every task
+_pages = None
+
+def _image_ext(page):
+    prerenderer = page.config.page_renderer.prerenderer
+    if prerenderer is None:
+        return None
+    return prerenderer.extensions.get('image')
+
+def _render_page(i):
+    page = _pages[i]
+    image_ext = _image_ext(page)
+    if image_ext is not None:
+        image_ext.used_images.clear()
+        image_ext.used_variants.clear()
+    
+    html = page.render()
+    timings = instrument.take_page_timings()
+    
+    if image_ext is None:
+        return html, [], [], timings
+    return html, list(image_ext.used_images), list(image_ext.used_variants), timings
+
+class RenderPool:
+    """Renders pages, in a pool of forked worker processes when jobs > 1
+        
+        Every page that will be rendered is passed up front, the workers are
+        forked once and inherit them, then render() can be called for any
+        subset of them (e.g. once per series). Output is still returned to the
+        calling process so writes to the output filesystem only happen there.
+        Use as a context manager, the workers exit at the end of the block.
+        
+        """
+    def __init__(self, pages, jobs=1):
+        self.pages = list(pages)
+        self.jobs = jobs
+        self._indexes = None
+        self._pool = None
+        self._image_ext = None
+    
+    def __enter__(self):
+        global _pages
+        pages = self.pages
+        jobs = self.jobs
+        if jobs <= 1 or len(pages) < jobs * 2 or 'fork' not in multiprocessing.get_all_start_methods():
+            return self
+        
+        self._image_ext = _image_ext(pages[0])
+        if self._image_ext is not None:
+            # workers only get what the image list had loaded when they were forked
+            self._image_ext.wait()
+        _pages = pages
+        self._indexes = {id(page): i for i, page in enumerate(pages)}
+        # when profiling, workers send back the timings of the pages they render
+        self._pool = multiprocessing.get_context('fork').Pool(jobs, initializer=instrument.forget_pages)
+        return self
+    
+    def __exit__(self, *exc):
+        global _pages
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        _pages = None
+    
+    def render(self, pages):
+        """Renders pages, which were passed to the pool, yielding (page, html) in their order"""
+        pages = list(pages)
+        if self._pool is None or len(pages) < self.jobs * 2:
+            for page in pages:
+                yield page, page.render()
+            return
+        
+        image_ext = self._image_ext
+        chunksize = max(1, min(64, len(pages) // (self.jobs * 4)))
+        results = self._pool.imap(_render_page, [self._indexes[id(page)] for page in pages], chunksize)
+        for page, (html, used_images, used_variants, timings) in zip(pages, results):
+            if image_ext is not None:
+                image_ext.used_images.update(used_images)
+                image_ext.used_variants.update(used_variants)
+            instrument.add_page_timings(timings)
+            yield page, html
+
+def render_pages(pages, jobs=1):
+    """Renders pages, yielding (page, html) in the order of pages"""
+    pages = list(pages)
+    with RenderPool(pages, jobs) as pool:
+        yield from pool.render(pages)
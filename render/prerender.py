@@ -1,40 +1,61 @@
+import re
 
-def find_all(s, exp):
-    index = 0
-    while True:
-        index = s.find(exp, index)
-        if index == -1:
-            break
-        yield index
-        index += len(exp)
+# {|command arg} on a single line, without another '{|' inside it so a stray
+# '{|' is left as text instead of swallowing the directive after it
+directive_re = re.compile(r'\{\|((?:(?!\{\|)[^}\n])*)\}')
+
+def tokenize(text):
+    """Splits text into a stream of tokens in a single pass
+        
+        yields ('text', text) for plain text and
+        ('directive', (source, command, arg)) for each {|command arg}
+        arg is None when the directive has no argument
+        
+        """
+    pos = 0
+    for match in directive_re.finditer(text):
+        start = match.start()
+        if start > pos:
+            yield 'text', text[pos:start]
+        command, sep, arg = match.group(1).partition(' ')
+        yield 'directive', (match.group(0), command, arg if sep else None)
+        pos = match.end()
+    if pos < len(text):
+        yield 'text', text[pos:]
 
 class PreRenderer:
     def __init__(self, extensions):
-        pass
         self.extensions = extensions
+        # messages about directives that were left in the text as is, each is
+        # only printed once since pages can be prerendered more than once
+        self.warnings = set()
+    
+    def warn(self, message):
+        if message not in self.warnings:
+            self.warnings.add(message)
+            print("prerender:", message)
     
     def render(self, text):
+        if '{|' not in text:
+            return text
+        
         new_text = []
-        end_i = -1
-        for start_i in find_all(text, '{|'):
-            new_text.append(text[end_i+1:start_i])
-            
-            end_i = text.find('}', start_i)
-            if end_i == -1:
-                end_i = start_i - 1
-                continue
-            next_newline_i = text.find('\n', start_i)
-            if next_newline_i != -1 and end_i > next_newline_i:
-                end_i = start_i - 1
+        extensions = self.extensions
+        for kind, value in tokenize(text):
+            if kind == 'text':
+                new_text.append(value)
                 continue
             
-            command = text[start_i+2:end_i]
-            command, arg = command.split(' ', 1)
-            #print(command, arg)
-            command_res = self.extensions[command](command, arg)
-            new_text.append(command_res)
-        
-        new_text.append(text[end_i+1:])
+            source, command, arg = value
+            extension = extensions.get(command)
+            if extension is None:
+                self.warn("unknown directive {}".format(source))
+                new_text.append(source)
+            elif arg is None:
+                self.warn("directive without argument {}".format(source))
+                new_text.append(source)
+            else:
+                new_text.append(extension(command, arg))
         
         return "".join(new_text)
 
@@ -49,9 +70,10 @@ def main():
         X-{|replace abcd}-X
         {|replace asd
         qwer{x a}
+        {|replace}{|nope x}
         ee{|replace abce}"""
     res = r.render(s)
     print(res)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
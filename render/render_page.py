@@ -1,8 +1,10 @@
-import markdown
-import mistune
+import hashlib
+import json
+
 import pystache
 
-from .navigation import gen_nav
+from .navigation import NavigationCache
+from .converters import MarkdownConverter
 from ordering import page_sort_key_predicate
 
 _default_templates = {
@@ -11,28 +13,133 @@ _default_templates = {
     'disqus': 'layouts/disqus.stache',
     'google-analytics': 'layouts/google-analytics.stache',
     'social-media': 'layouts/socialbs.stache',
+    'blog_post': 'layouts/blog_post.stache',
 }
 
+# bump when changes to the rendering code change its output, invalidates cached pages
+_render_version = 1
+
 class PageRenderer:
-    def __init__(self, config, *, prerenderer=None):
+    def __init__(self, config, *, prerenderer=None, cache=None):
         self.url_prefix = config.path_prefix
         self.config = config
         self.templates = {}
+        self.template_version = None
+        self._compiled_templates = {}
+        self._template_renderer = pystache.Renderer()
         self.load_templates()
         self.hard_links = False
-        self.navigation = None
+        self.navigation = NavigationCache()
         self.prerenderer = prerenderer
-        
-        renderer = mistune.Renderer(escape=False)
-        mistune_markdown = mistune.Markdown(renderer=renderer)
-        self._mistune_markdown = mistune_markdown
+        self.cache = cache
+        self.markdown = MarkdownConverter()
+        # bumped when prerendered content kept on pages is out of date
+        self.prepared_version = 0
     
     def load_templates(self):
+        self._compiled_templates = {}
         for template_name, template_fn in _default_templates.items():
             with open(template_fn, encoding='utf8') as f:
                 self.templates[template_name] = f.read()
+        
+        m = hashlib.sha256()
+        for template_name, template in sorted(self.templates.items()):
+            m.update(template_name.encode())
+            m.update(template.encode())
+        self.template_version = m.hexdigest()
+    
+    def render_template(self, template_key, params):
+        """Renders a template, parsing it only the first time it's used"""
+        try:
+            template = self._compiled_templates[template_key]
+        except KeyError:
+            template = pystache.parse(self.templates[template_key])
+            self._compiled_templates[template_key] = template
+        return self._template_renderer.render(template, params)
+    
+    def get_navigation(self, page):
+        return self.navigation.get(page.root)
+    
+    def get_navigation_digest(self, page):
+        return self.navigation.digest(page.root)
+    
+    def invalidate_navigation(self, series_id=None):
+        self.navigation.invalidate(series_id)
+    
+    def page_hash(self, page):
+        """Hash of everything that goes into rendering a page, used to skip unchanged pages"""
+        config = self.config
+        inputs = [
+            self.template_version,
+            self.get_navigation_digest(page),
+            self.url_prefix,
+            config.get('enabled', {}),
+            config['include-raw'],
+            page.series.header_url,
+            page.get_fs_series_path(),
+            page.get_fs_path(),
+            page.get_path(),
+            page.renderer,
+            page.title,
+            page.is_index,
+            None if page.is_index else self.content_digest(page),
+        ]
+        if self.hard_links:
+            inputs.append([(child.path_part, child.get_title()) for child in page])
+        
+        data = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+    
+    def _prepare(self, page):
+        """(prerendered content, digest of the raw and prerendered content) of page
+            
+            Kept on the page so hashing and rendering it only prerenders once,
+            until its content changes or forget_prepared is called.
+            
+            """
+        prepared = page._prepared
+        if prepared is not None and prepared[0] == self.prepared_version:
+            return prepared[1], prepared[2]
+        
+        content = page.content
+        prerendered = content
+        if page.renderer and 'preproc' in page.renderer.split('+'):
+            if self.prerenderer is not None:
+                prerendered = self.prerenderer.render(content)
+        # the raw content is written to raw.md, so it counts even when it
+        # prerenders the same
+        m = hashlib.sha256(content.encode())
+        m.update(b'\0')
+        m.update(prerendered.encode())
+        digest = m.hexdigest()
+        
+        page._prepared = (self.prepared_version, prerendered, digest)
+        return prerendered, digest
+    
+    def forget_prepared(self):
+        """Prerenders pages again, e.g. after the image list changed"""
+        self.prepared_version += 1
+    
+    def prerender(self, page):
+        """Page content after the preproc step, if the page uses it"""
+        return self._prepare(page)[0]
+    
+    def content_digest(self, page):
+        return self._prepare(page)[1]
     
     def render(self, page, template_key, inner_template=None, *, inner_only=False):
+        if self.cache is None:
+            return self._render(page, template_key, inner_template, inner_only=inner_only)
+        
+        key_data = "{}:{}:{}:{}:{}".format(_render_version, self.page_hash(page), template_key, inner_template, inner_only)
+        key = hashlib.sha256(key_data.encode()).hexdigest()
+        content = self.cache.get(key)
+        if content is None:
+            content = self._render(page, template_key, inner_template, inner_only=inner_only)
+            self.cache.set(key, content)
+        return content
+    
+    def _render(self, page, template_key, inner_template=None, *, inner_only=False):
         url_prefix = self.url_prefix
         config = self.config
         templates = self.templates
@@ -69,24 +176,20 @@ class PageRenderer:
             postfix = '</pre></code>' + postfix
         
         if not page.is_index:
-            content = page.content
-            if 'preproc' in renderers:
-                if self.prerenderer is not None:
-                    content = self.prerenderer.render(content)
+            content = self.prerender(page)
             if 'markdown' in renderers or 'markdown-mistune' in renderers:
-                content = self._mistune_markdown(content)
+                content = self.markdown.convert('mistune', content)
             if 'markdown-mistune-nohtml' in renderers:
-                content = mistune.markdown(content)
+                content = self.markdown.convert('mistune-nohtml', content)
             if 'markdown-markdown' in renderers:
-                content = markdown.markdown(content, extensions=['markdown.extensions.footnotes'])
+                content = self.markdown.convert('markdown', content)
             content = prefix + content + postfix
             title = page.title
         else:
             content = prefix + postfix
             title = "Index"
         
-        if self.navigation is None or page.series.id != self.navigation[0]:
-            self.navigation = (page.series.id, gen_nav(page.root, page))
+        navigation = self.get_navigation(page)
         
         if inner_only:
             return content
@@ -98,7 +201,7 @@ class PageRenderer:
             'title': title,
             'header_url': page.series.header_url,
             'series_url': page.get_fs_series_path(),
-            'navbar': self.navigation[1],
+            'navbar': navigation,
         }
         
         enabled = config.get('enabled', {})
@@ -112,7 +215,7 @@ class PageRenderer:
             disqus_params = {
                 'full_path': d_path
             }
-            disqus_html = pystache.render(templates['disqus'], disqus_params)
+            disqus_html = self.render_template('disqus', disqus_params)
             params['disqus'] = disqus_html
         
         if enabled.get('google-analytics'):
@@ -122,7 +225,7 @@ class PageRenderer:
             params['social_media'] = templates['social-media']
         
         if inner_template:
-            params['content'] = pystache.render(templates[inner_template], params)
+            params['content'] = self.render_template(inner_template, params)
         
-        content = pystache.render(templates[template_key], params)
+        content = self.render_template(template_key, params)
         return content
@@ -1,12 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 import tornado.ioloop
+import tornado.locks
+import tornado.util
 import tornado.web
-from fs.errors import FileExpected, ResourceNotFound
 
-def start_single_page_server(debug_fs, single_page_cb, port=8000, special=None, debug=False):
+from static_files import StaticFiles
+
+# seconds a request waits for a free render slot before getting a 503
+_queue_timeout = 30
+
+def start_single_page_server(debug_fs, fetch_cb, prepare_cb, port=8000, special=None, debug=False, *, fetch_workers=4, concurrency=16):
+    """Serves page previews from /p/<id> and /pi/<id> (inner html only)
+        
+        fetch_cb(page_id) - reads a page, returns None if it doesn't exist,
+            run in a pool of fetch_workers threads
+        prepare_cb(fetched, inner_only=) - returns (etag, render) where render()
+            returns the page's html, both run on a single render thread
+        
+        At most concurrency previews are handled at once, so the IOLoop keeps
+        serving other requests while pages are fetched and rendered.
+        
+        """
     if special is None:
         special = {}
+    fetch_executor = ThreadPoolExecutor(fetch_workers)
+    # the page renderer isn't thread safe, all rendering happens on one thread
+    render_executor = ThreadPoolExecutor(1)
+    semaphore = tornado.locks.Semaphore(concurrency)
+    static_files = StaticFiles()
+    
     class DebugHandler(tornado.web.RequestHandler):
-        def get(self):
+        async def single_page(self, page_id, inner_only):
+            try:
+                await semaphore.acquire(timeout=timedelta(seconds=_queue_timeout))
+            except tornado.util.TimeoutError:
+                self.set_status(503)
+                self.finish("too many requests")
+                return
+            try:
+                io_loop = tornado.ioloop.IOLoop.current()
+                fetched = await io_loop.run_in_executor(fetch_executor, fetch_cb, page_id)
+                if fetched is None:
+                    self.set_status(404)
+                    self.finish("page not found")
+                    return
+                
+                etag, render = await io_loop.run_in_executor(
+                    render_executor, lambda: prepare_cb(fetched, inner_only=inner_only))
+                self.set_header('Content-Type', 'text/html; charset=UTF-8')
+                # previews can change any time, make clients revalidate with the etag
+                self.set_header('Cache-Control', 'no-cache')
+                self.set_header('Etag', etag)
+                if self.check_etag_header():
+                    self.set_status(304)
+                    self.finish()
+                    return
+                
+                data = await io_loop.run_in_executor(render_executor, render)
+                self.finish(data)
+            finally:
+                semaphore.release()
+        
+        async def get(self):
             # print(self.request.uri)
             uri = self.request.uri
             
@@ -18,35 +75,15 @@ def start_single_page_server(debug_fs, single_page_cb, port=8000, special=None,
             if uri.startswith('/p/'):
                 page_id = uri.split('/')[2]
                 # print("SINGLE PAGE CALL", uri, page_id)
-                data = single_page_cb(page_id)
-                self.finish(data)
+                await self.single_page(page_id, False)
                 return
             if uri.startswith('/pi/'):
                 page_id = uri.split('/')[2]
                 # print("SINGLE PAGE CALL", uri, page_id)
-                data = single_page_cb(page_id, inner_only=True)
-                self.finish(data)
+                await self.single_page(page_id, True)
                 return
             
-            if uri == '/':
-                self.finish(debug_fs.open("/index.html").read())  
-                return
-            try:
-                if uri.endswith('.css'):
-                    self.set_header('Content-Type', 'text/css')
-                if uri.endswith('.jpg'):
-                    self.set_header('Content-Type', 'image/jpg')
-                #self.finish(debug_fs.open(uri).read())
-                self.finish(debug_fs.getbytes(uri))
-            except FileExpected:
-                if not uri.endswith('/'):
-                    self.redirect('{}/'.format(uri), True)
-                    return
-                self.finish(debug_fs.open(uri + "/index.html").read())
-            except ResourceNotFound:
-                self.set_status(404)
-                self.finish()
-            
+            await static_files.send(self, debug_fs, uri.split('?', 1)[0])
     
     app = tornado.web.Application([
         (r"/.*", DebugHandler),
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import hashlib
+import json
+import time
+
+from page import Page
+
+class SeriesTreeCache:
+    """Full page trees of recently previewed series, least recently used are dropped
+        
+        Trees are keyed by a fingerprint of the series document and its pages,
+        so they are reloaded once anything in the series changes. The pages are
+        checked against the database at most once every revalidate_interval
+        seconds per series. Previews are rendered from the page's current
+        document, placed in the cached tree without modifying it, so the cached
+        navigation stays valid.
+        
+        """
+    def __init__(self, state, max_series=8, revalidate_interval=5):
+        self.state = state
+        self.max_series = max_series
+        self.revalidate_interval = revalidate_interval
+        self._trees = OrderedDict()
+        # series id -> (fingerprint of its pages, when it was read)
+        self._page_hashes = {}
+    
+    def _fingerprint(self, page_hash, raw_series):
+        m = hashlib.sha256()
+        m.update(page_hash.encode())
+        m.update(json.dumps(raw_series, sort_keys=True, default=str).encode())
+        return m.hexdigest()
+    
+    def fingerprint(self, raw_series):
+        """Changes whenever the series or any of its pages change
+            
+            None for series that aren't loaded, get_tree reads their
+            fingerprint along with the pages.
+            
+            """
+        series_id = str(raw_series['_id'])
+        cached = self._page_hashes.get(series_id)
+        if cached is None:
+            return None
+        page_hash, checked = cached
+        if time.monotonic() - checked >= self.revalidate_interval:
+            from build import Series, series_fingerprints, series_page_query
+            config = self.state.config
+            series = Series(raw_series, config)
+            page_hashes = series_fingerprints(self.state, [series], series_page_query(config, [series.id]))
+            page_hash = page_hashes.get(series.id, '')
+            self._page_hashes[series_id] = (page_hash, time.monotonic())
+        return self._fingerprint(page_hash, raw_series)
+    
+    def get_tree(self, raw_series, fingerprint):
+        from build import Series, retrieve_pages
+        series_id = str(raw_series['_id'])
+        cached = self._trees.get(series_id)
+        if fingerprint is not None and cached is not None and cached[0] == fingerprint:
+            self._trees.move_to_end(series_id)
+            return cached[1]
+        
+        series = Series(raw_series, self.state.config)
+        all_pages, _, page_hashes = retrieve_pages(self.state, [series], {})
+        root = all_pages[series.id]
+        # the fingerprint retrieve_pages computed is current, no need to read it again
+        page_hash = page_hashes.get(series.id, '')
+        self._page_hashes[series_id] = (page_hash, time.monotonic())
+        
+        self._trees[series_id] = (self._fingerprint(page_hash, raw_series), root)
+        self._trees.move_to_end(series_id)
+        while len(self._trees) > self.max_series:
+            evicted_id, _ = self._trees.popitem(last=False)
+            self._page_hashes.pop(evicted_id, None)
+        return root
+    
+    def preview_page(self, raw_page, raw_series, fingerprint):
+        """Page for raw_page inside its series' cached tree"""
+        from build import page_tree_path, single_page_tree
+        if raw_page.get('meta', {}).get('blog'):
+            # blog posts are placed by blog.process_blog_posts, not by their meta
+            return single_page_tree(self.state, raw_page, raw_series)
+        
+        root = self.get_tree(raw_series, fingerprint)
+        series = root.series
+        path = page_tree_path(raw_page, series)
+        
+        # parents the page doesn't have in the tree (e.g. it isn't published
+        # yet) are only created for the preview, not added to the tree
+        parent = None
+        if path:
+            parent = root
+            for i, p in enumerate(path[:-1]):
+                child = parent.children.get(p)
+                if child is None:
+                    child = Page(series=series, root=root, parent=parent)
+                    child.path = tuple(path[:i+1])
+                    child.path_part = p
+                parent = child
+        
+        # filled in as its own root so the cached tree's version isn't bumped
+        page = Page(series=series)
+        page.set_raw_page(raw_page)
+        page.root = root
+        page.parent = parent
+        page.path = tuple(path)
+        if path:
+            page.path_part = path[-1]
+            existing = parent.children.get(path[-1])
+        else:
+            existing = root
+        if existing is not None:
+            page.children = existing.children
+        return page
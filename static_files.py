@@ -0,0 +1,170 @@
+from collections import OrderedDict
+import email.utils
+import gzip
+import hashlib
+import mimetypes
+import re
+
+import fs.path
+from fs.errors import ResourceNotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_chunk_size = 64 * 1024
+
+# types worth compressing, everything else (images, fonts, ...) already is
+_compressible = re.compile(r'^(text/|application/(javascript|json|xml)|image/svg\+xml)')
+
+def _content_type(path):
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+        content_type += '; charset=UTF-8'
+    return content_type
+
+def _parse_range(range_header, size):
+    """(start, end) of a single 'bytes=start-end' range, None if it can't be served"""
+    match = re.match(r'^bytes=(\d*)-(\d*)$', range_header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        start = max(0, size - int(match.group(2)))
+        end = size
+    else:
+        start = int(match.group(1))
+        end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+    if start >= end:
+        return None
+    return start, end
+
+class StaticFiles:
+    """Sends files from a filesystem through tornado request handlers
+        
+        Files are streamed in chunks with their mime type, ETag and
+        Last-Modified, answering conditional requests with 304 and range
+        requests with 206. Text files are compressed with brotli (if it is
+        installed) or gzip, compressed copies are kept in memory until
+        max_compressed bytes are used so each file is only compressed once.
+        
+        """
+    def __init__(self, max_compressed=32 * 1024 * 1024):
+        self.max_compressed = max_compressed
+        self._compressed = OrderedDict()
+        self._compressed_size = 0
+    
+    def _compress(self, key, data, encoding):
+        cached = self._compressed.get(key)
+        if cached is not None:
+            self._compressed.move_to_end(key)
+            return cached
+        
+        if encoding == 'br':
+            compressed = brotli.compress(data)
+        else:
+            compressed = gzip.compress(data, compresslevel=6)
+        
+        self._compressed[key] = compressed
+        self._compressed_size += len(compressed)
+        while self._compressed_size > self.max_compressed and self._compressed:
+            _, evicted = self._compressed.popitem(last=False)
+            self._compressed_size -= len(evicted)
+        return compressed
+    
+    def _encoding(self, handler):
+        accept_encoding = handler.request.headers.get('Accept-Encoding', '')
+        encodings = {e.split(';')[0].strip() for e in accept_encoding.split(',')}
+        if brotli is not None and 'br' in encodings:
+            return 'br'
+        if 'gzip' in encodings:
+            return 'gzip'
+        return None
+    
+    def _not_modified_since(self, handler, modified):
+        since = handler.request.headers.get('If-Modified-Since')
+        if not since or modified is None or handler.request.headers.get('If-None-Match'):
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since)
+        except (TypeError, ValueError):
+            return False
+        return int(modified.timestamp()) <= since.timestamp()
+    
+    async def send(self, handler, src_fs, path, *, transform_html=None):
+        """Finishes the request with the file at path, or a 404 or redirect
+            
+            transform_html - optional function applied to the bytes of html files
+            
+            """
+        try:
+            info = src_fs.getinfo(path, namespaces=['details'])
+            if info.is_dir:
+                if not path.endswith('/'):
+                    handler.redirect('{}/'.format(path), True)
+                    return
+                path = fs.path.join(path, 'index.html')
+                info = src_fs.getinfo(path, namespaces=['details'])
+        except ResourceNotFound:
+            handler.set_status(404)
+            handler.finish()
+            return
+        
+        size = info.size
+        modified = info.modified
+        content_type = _content_type(path)
+        if transform_html is None or not content_type.startswith('text/html'):
+            transform_html = None
+        
+        etag = None
+        handler.set_header('Content-Type', content_type)
+        if modified is not None:
+            etag = '"{:x}-{:x}"'.format(size, int(modified.timestamp() * 1000000))
+            handler.set_header('Etag', etag)
+            handler.set_header('Last-Modified', modified)
+        # files change while previewing, clients keep them but revalidate
+        handler.set_header('Cache-Control', 'no-cache')
+        handler.set_header('Vary', 'Accept-Encoding')
+        if etag is not None and (handler.check_etag_header() or self._not_modified_since(handler, modified)):
+            handler.set_status(304)
+            handler.finish()
+            return
+        
+        encoding = self._encoding(handler) if _compressible.match(content_type) and size >= 256 else None
+        range_header = handler.request.headers.get('Range')
+        if transform_html is not None or (encoding is not None and not range_header):
+            data = src_fs.getbytes(path)
+            if transform_html is not None:
+                data = transform_html(data)
+            if encoding is not None:
+                key = (path, etag or hashlib.sha1(data).hexdigest(), encoding, transform_html is not None)
+                data = self._compress(key, data, encoding)
+                handler.set_header('Content-Encoding', encoding)
+            handler.finish(data)
+            return
+        
+        start, end = 0, size
+        handler.set_header('Accept-Ranges', 'bytes')
+        if range_header:
+            byte_range = _parse_range(range_header, size)
+            if byte_range is None:
+                handler.set_status(416)
+                handler.set_header('Content-Range', 'bytes */{}'.format(size))
+                handler.finish()
+                return
+            start, end = byte_range
+            handler.set_status(206)
+            handler.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size))
+        
+        handler.set_header('Content-Length', end - start)
+        with src_fs.openbin(path) as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(_chunk_size, remaining))
+                if not chunk:
+                    break
+                handler.write(chunk)
+                await handler.flush()
+                remaining -= len(chunk)
+        handler.finish()
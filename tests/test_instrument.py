@@ -0,0 +1,70 @@
+import unittest
+
+import instrument
+from page import Page
+from render import PageRenderer
+
+class TestConfig(dict):
+    path_prefix = ''
+    url_prefix = ''
+    series_prefix = True
+    page_renderer = None
+
+class TestSeries:
+    id = 'series-id'
+    name = 'Test Series'
+    path_part = 'test-series'
+    header_url = ''
+    fixed_nav_entries = False
+    hier = ['volume', 'chapter']
+    
+    def __init__(self, config):
+        self.config = config
+
+def build_tree(config, volumes, chapters):
+    root = Page(series=TestSeries(config))
+    for volume in range(1, volumes + 1):
+        for chapter in range(1, chapters + 1):
+            raw_page = {
+                'content': "volume {} chapter {}".format(volume, chapter),
+                'meta': {'title': "Chapter {}".format(chapter), 'order': chapter},
+            }
+            root.add_page([volume, chapter], raw_page)
+    return root
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.config = TestConfig({'include-raw': True})
+        self.page_renderer = PageRenderer(self.config)
+        self.config.page_renderer = self.page_renderer
+        self.root = build_tree(self.config, 5, 20)
+        self.profiler = instrument.Profiler()
+        self.profiler.instrument(self.page_renderer)
+    
+    def hash_pages(self):
+        self.profiler.start()
+        try:
+            with instrument.stage('hash'):
+                for page in self.root.recurse():
+                    self.page_renderer.page_hash(page)
+        finally:
+            self.profiler.stop()
+    
+    def test_navigation_is_timed(self):
+        self.hash_pages()
+        report = self.profiler.report()
+        series, = report['series']
+        self.assertEqual(series['pages'], 1 + 5 + 5 * 20)
+        self.assertGreater(series['nav'], 0)
+        self.assertGreater(series['prerender'], 0)
+        self.assertLessEqual(series['nav'] + series['prerender'], series['total'])
+    
+    def test_stages(self):
+        self.hash_pages()
+        stage, = self.profiler.report()['stages']
+        self.assertEqual(stage['name'], 'hash')
+        self.assertGreater(stage['wall'], 0)
+        self.assertIn('hash ', self.profiler.folded())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from render.prerender import PreRenderer, tokenize
+
+def replace_ext(command, arg):
+    return "REPLACE({})".format(arg)
+
+class TokenizeTest(unittest.TestCase):
+    def test_directives_and_text(self):
+        tokens = list(tokenize("a {|image x.png} b {|nav}"))
+        self.assertEqual(tokens, [
+            ('text', "a "),
+            ('directive', ("{|image x.png}", 'image', "x.png")),
+            ('text', " b "),
+            ('directive', ("{|nav}", 'nav', None)),
+        ])
+    
+    def test_stray_opening_is_text(self):
+        tokens = list(tokenize("{|a {|b}"))
+        self.assertEqual(tokens, [
+            ('text', "{|a "),
+            ('directive', ("{|b}", 'b', None)),
+        ])
+    
+    def test_directives_stay_on_one_line(self):
+        self.assertEqual(list(tokenize("{|replace a\nb}")), [('text', "{|replace a\nb}")])
+
+class PreRendererTest(unittest.TestCase):
+    def test_render(self):
+        r = PreRenderer({'replace': replace_ext})
+        self.assertEqual(r.render("x {|replace a} y"), "x REPLACE(a) y")
+    
+    def test_stray_opening_before_directive(self):
+        r = PreRenderer({'replace': replace_ext})
+        self.assertEqual(r.render("{|replace {|replace b}"), "{|replace REPLACE(b)")
+    
+    def test_unknown_directives_are_kept(self):
+        r = PreRenderer({'replace': replace_ext})
+        self.assertEqual(r.render("{|nope x}{|replace}"), "{|nope x}{|replace}")
+        self.assertEqual(len(r.warnings), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,11 @@
 def try_int(x, default=0):
+    # common cases that don't need to go through an exception
+    if isinstance(x, int):
+        return int(x)
+    if isinstance(x, str) and x.isdecimal():
+        return int(x)
+    if x is None:
+        return default
     try:
         return int(x)
     except (ValueError, TypeError):
@@ -0,0 +1,221 @@
+"""Continuous builds
+
+Builds once and keeps the page trees of every series in memory. Changes are
+picked up from mongo change streams on ndtest.pages and ndtest.series, which
+need a replica set, and applied to the trees by document id, so only the
+edited pages and the pages whose navigation they change are rendered again.
+When change streams aren't available the series fingerprints are checked
+every watch-poll-interval seconds instead and changed series are reloaded.
+
+"""
+
+import queue
+import threading
+import time
+
+from pymongo.errors import PyMongoError
+
+def _follow_changes(state, collection_name, events):
+    collection = state.get_mongo().ndtest[collection_name]
+    pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+    try:
+        with collection.watch(pipeline) as stream:
+            for change in stream:
+                events.put((collection_name, change.get('documentKey')))
+    except PyMongoError as e:
+        print("change stream on {} stopped, falling back to polling: {}".format(collection_name, e))
+
+def start_change_streams(state, events):
+    threads = []
+    for collection_name in ('pages', 'series'):
+        thread = threading.Thread(target=_follow_changes, args=(state, collection_name, events), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def wait_for_changes(events, poll_interval, debounce):
+    """Blocks until a change arrives or poll_interval passes, returns the changes
+        
+        After the first change, waits until no change has arrived for debounce
+        seconds (but at most poll_interval) so bursts of edits build once.
+        Changes are (collection name, document key) pairs.
+        
+        """
+    try:
+        changes = [events.get(timeout=poll_interval)]
+    except queue.Empty:
+        return []
+    
+    deadline = time.monotonic() + poll_interval
+    while time.monotonic() < deadline:
+        try:
+            changes.append(events.get(timeout=debounce))
+        except queue.Empty:
+            break
+    return changes
+
+class LiveTrees:
+    """Page trees of every series, kept between builds
+        
+        Changed pages are read by id and put into their tree in place. Pages
+        that were removed, moved or are blog posts reload their whole series,
+        as do changes to series documents.
+        
+        """
+    def __init__(self, state):
+        self.state = state
+        self.series_list = []
+        self.trees = {}
+        self.fingerprints = {}
+        # page id -> (series id, path in the tree)
+        self.page_index = {}
+    
+    def load(self):
+        from build import retrieve_series, retrieve_pages
+        self.series_list = retrieve_series(self.state)
+        self.page_index = {}
+        self.trees, _, self.fingerprints = retrieve_pages(
+            self.state, self.series_list, {}, page_index=self.page_index)
+    
+    def _reload(self, series_ids):
+        from build import retrieve_pages
+        series_list = [s for s in self.series_list if s.id in series_ids]
+        self.page_index = {
+            page_id: entry for page_id, entry in self.page_index.items()
+            if entry[0] not in series_ids
+        }
+        trees, _, fingerprints = retrieve_pages(self.state, series_list, {}, page_index=self.page_index)
+        self.trees.update(trees)
+        self.fingerprints.update(fingerprints)
+    
+    def _update_series_list(self, reload):
+        """Reads the series again, adding new and changed series to reload"""
+        from build import retrieve_series
+        old_series = {s.id: s.raw_series for s in self.series_list}
+        self.series_list = retrieve_series(self.state)
+        
+        series_ids = {s.id for s in self.series_list}
+        for series_id in set(old_series) - series_ids:
+            self.trees.pop(series_id, None)
+            self.fingerprints.pop(series_id, None)
+            self.page_index = {k: v for k, v in self.page_index.items() if v[0] != series_id}
+        for series in self.series_list:
+            if old_series.get(series.id) != series.raw_series:
+                reload.add(series.id)
+    
+    def _apply_page(self, page_id, changed, reload):
+        from build import page_tree_path
+        config = self.state.config
+        old = self.page_index.get(str(page_id))
+        
+        raw_page = self.state.get_mongo().ndtest.pages.find_one({'_id': page_id})
+        meta = raw_page.get('meta', {}) if raw_page is not None else {}
+        min_status = config['min-status']
+        hidden = (
+            raw_page is None or meta.get('deleted')
+            or (min_status is not None and (meta.get('status') or 0) < min_status)
+        )
+        if hidden:
+            if old is not None:
+                reload.add(old[0])
+            return
+        
+        series_id = str(raw_page['series'])
+        root = self.trees.get(series_id)
+        if root is None:
+            # not a series that is being built
+            if old is not None:
+                reload.add(old[0])
+            return
+        if meta.get('blog'):
+            if root.series.blog_path is not None:
+                reload.add(series_id)
+            return
+        
+        path = tuple(page_tree_path(raw_page, root.series))
+        if old is not None and old != (series_id, path):
+            reload.add(old[0])
+            reload.add(series_id)
+            return
+        
+        # updates the page if it exists, adds it otherwise
+        root.add_page(list(path), raw_page)
+        self.page_index[str(page_id)] = (series_id, path)
+        changed.add(series_id)
+    
+    def _refresh_fingerprints(self, series_ids):
+        from build import series_fingerprints, series_page_query
+        series_list = [s for s in self.series_list if s.id in series_ids]
+        if series_list:
+            query = series_page_query(self.state.config, [s.id for s in series_list])
+            self.fingerprints.update(series_fingerprints(self.state, series_list, query))
+    
+    def apply(self, changes):
+        """Applies (collection name, document key) changes, returns the ids of changed series"""
+        changed = set()
+        reload = set()
+        if any(collection_name == 'series' for collection_name, _ in changes):
+            self._update_series_list(reload)
+        
+        page_ids = {key['_id'] for collection_name, key in changes if collection_name == 'pages' and key}
+        for page_id in page_ids:
+            self._apply_page(page_id, changed, reload)
+        
+        if reload:
+            self._reload(reload)
+        self._refresh_fingerprints(changed - reload)
+        return changed | reload
+    
+    def poll(self):
+        """Reloads series whose fingerprint changed, returns their ids"""
+        from build import series_fingerprints, series_page_query
+        reload = set()
+        self._update_series_list(reload)
+        query = series_page_query(self.state.config, [s.id for s in self.series_list])
+        fingerprints = series_fingerprints(self.state, self.series_list, query)
+        reload.update(
+            series_id for series_id, fingerprint in fingerprints.items()
+            if self.fingerprints.get(series_id) != fingerprint
+        )
+        if reload:
+            self._reload(reload)
+        return reload
+    
+    def build(self, deploy_target, series_ids):
+        all_pages = {series_id: self.trees[series_id] for series_id in series_ids if series_id in self.trees}
+        deploy_target.gen_fs(all_pages, self.series_list)
+        deploy_target.post_gen(dict(self.fingerprints))
+
+def watch(state, deploy_target, present_series):
+    config = state.config
+    poll_interval = config.get('watch-poll-interval') or 60
+    debounce = config.get('watch-debounce') or 2
+    
+    events = queue.Queue()
+    streams = start_change_streams(state, events)
+    
+    live_trees = LiveTrees(state)
+    live_trees.load()
+    changed = [
+        series_id for series_id, fingerprint in live_trees.fingerprints.items()
+        if present_series.get(series_id) != fingerprint
+    ]
+    if changed:
+        live_trees.build(deploy_target, changed)
+    else:
+        print("NOTHING TO DO")
+    # everything is generated now, later runs only update changed series
+    state.partial_build = True
+    
+    while True:
+        changes = wait_for_changes(events, poll_interval, debounce)
+        if changes:
+            print("{} changes, rebuilding".format(len(changes)))
+            changed = live_trees.apply(changes)
+        elif all(stream.is_alive() for stream in streams):
+            # nothing can have changed without an event
+            continue
+        else:
+            changed = live_trees.poll()
+        if changed:
+            live_trees.build(deploy_target, changed)